@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+
+"""Benchmarks of the prediction paths and of the data pipeline, run from the project root, e.g.:
+
+    python ./src/benchmark.py tta -m u_net
+    python ./src/benchmark.py fcn
+    python ./src/benchmark.py startup
+    python ./src/benchmark.py pipeline --assets synthetic -o pipeline.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from utils.commons import latest_run, properties
+
+# runs a script as __main__ with the given arguments and reports its wall time and the heavy modules it imported
+STARTUP_PROBE = """
+import json, runpy, sys, time
+start = time.time()
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+finally:
+    sys.stderr.write("\\n{} " + json.dumps({{"seconds": time.time() - start,
+                                            "modules": [name for name in {} if name in sys.modules]}}) + "\\n")
+"""
+STARTUP_MARKER = "[STARTUP]"
+HEAVY_MODULES = ("tensorflow", "keras", "scipy", "matplotlib.pyplot")
+
+PIPELINE_CASES = ("image_to_patch", "patch_train", "patch_test", "augment", "submission_cnn", "submission_u_net")
+PIPELINE_MARKER = "[PIPELINE]"
+# optional modules of the pipeline cases, which are skipped where they are not installed
+PIPELINE_REQUIREMENTS = {"augment": "keras"}
+
+
+def benchmark_tta(model, image_files, mask_files, overlap=64, batch_size=None):
+    """Compares the latency and the validation scores of U-Net predictions with and without test-time augmentation.
+
+    Args:
+        model (models.u_net_pixel_to_patch.UNet): the restored model.
+        image_files (list): paths of the images.
+        mask_files (list): paths of their ground truth masks.
+
+    Returns:
+        list: per mode, a dict of the latency per image in seconds, the F1 score and the accuracy at the default
+        thresholds and the best F1 score over `utils.evaluation.THRESHOLDS`.
+    """
+    from scipy import ndimage
+
+    from utils import evaluation
+    from utils.storage import to_model
+
+    images = [to_model(ndimage.imread(image_file)[..., :3]) for image_file in image_files]
+    fractions = [evaluation.foreground_fractions(ndimage.imread(mask_file) / 255., model.patch_size)
+                 for mask_file in mask_files]
+    default = (list(evaluation.FOREGROUND_THRESHOLDS).index(0.25), list(evaluation.THRESHOLDS).index(0.5))
+
+    results = []
+    model.predict_grids(images[:1], overlap=overlap, batch_size=batch_size)  # warm up
+    for tta in (False, True):
+        start = time.time()
+        grids = model.predict_grids(images, overlap=overlap, batch_size=batch_size, tta=tta)
+        latency = (time.time() - start) / len(images)
+
+        matrices = evaluation.confusion_matrices(np.concatenate([grid.ravel() for grid in grids]),
+                                                 np.concatenate([fraction.ravel() for fraction in fractions]))
+        f1, accuracy = evaluation.scores(matrices)
+        results.append({"tta": tta, "latency": latency, "f1": f1[default], "accuracy": accuracy[default],
+                        "best_f1": f1[default[0]].max()})
+        print("[INFO] TTA {}: {:.3f}s per image, F1 {:.4f}, accuracy {:.4f}, best F1 {:.4f}".format(
+            "on " if tta else "off", latency, f1[default], accuracy[default], f1[default[0]].max()))
+    return results
+
+
+def benchmark_fcn(model_class, test_generator, batch_size=512):
+    """Compares the latency and the predictions of cnn_lr_d scoring one window per patch and of its fully
+    convolutional copy scoring whole images.
+
+    Args:
+        model_class (models.cnn_lr_d.CnnLrD): the restored model.
+        test_generator (generators.PatchTestImageGenerator.PatchTestImageGenerator): the images to predict.
+
+    Returns:
+        dict: the latency per image in seconds of both, the largest difference of their road probabilities and the
+        fraction of patches they label alike at 0.5.
+    """
+    from models.predict_on_tests import FullImageInferenceEngine, PatchInferenceEngine
+
+    images = list(test_generator.images())
+    engines = {"windows": (PatchInferenceEngine(model_class.model, batch_size=batch_size),
+                           [test_generator.get_test_patches_from_image(image)[1] for image in images]),
+               "fcn": (FullImageInferenceEngine(model_class.fully_convolutional()), images)}
+
+    results = {}
+    grids = {}
+    for name, (engine, inputs) in engines.items():
+        list(engine.predict_grids(inputs[:1]))  # warm up
+        start = time.time()
+        grids[name] = np.stack([grid[..., 1] for grid in engine.predict_grids(inputs)])
+        results[name] = (time.time() - start) / len(images)
+        print("[INFO] {}: {:.3f}s per image".format(name, results[name]))
+
+    results["max_difference"] = float(np.abs(grids["fcn"] - grids["windows"]).max())
+    results["agreement"] = float(np.mean((grids["fcn"] > 0.5) == (grids["windows"] > 0.5)))
+    print("[INFO] Speed-up {:.1f}x, largest probability difference {:.4f}, labels agreeing {:.4f}".format(
+        results["windows"] / results["fcn"], results["max_difference"], results["agreement"]))
+    return results
+
+
+def startup_cases(directory):
+    """Returns the startup cases of `benchmark_startup`, writing the submissions they merge to `directory`.
+
+    Returns:
+        list: per case, its name, the script it runs, its arguments and the heavy modules it may import.
+    """
+    from utils.submission import SubmissionWriter
+
+    submissions = []
+    for idx in range(2):
+        submissions.append(os.path.join(directory, "submission_{}.csv".format(idx)))
+        with SubmissionWriter(submissions[-1], 16, 0.5) as writer:
+            for image_id in range(1, 51):
+                writer.write("{:03d}".format(image_id), np.random.rand(38, 38))
+
+    visualization_script = os.path.join(directory, "import_visualization.py")
+    with open(visualization_script, "w") as file:
+        file.write("import visualization\n")
+
+    run_script = os.path.join(properties["SRC_DIR"], "run.py")
+    return [("run.py --help", run_script, ["--help"], ()),
+            ("run.py --merge", run_script, ["--merge"] + submissions + ["-o", os.path.join(directory, "merged.csv")],
+             ()),
+            ("import visualization", visualization_script, [], ("matplotlib.pyplot",))]
+
+
+def benchmark_startup(cases, repeats=3, max_seconds=None):
+    """Measures the startup time of command line actions which do not run a model, each in a fresh interpreter.
+
+    Args:
+        cases (list): per case, its name, the script it runs, its arguments and the heavy modules it may import.
+        repeats (int): runs per case, the fastest is reported.
+        max_seconds (float): startup time above which a case fails, None for no limit.
+
+    Returns:
+        bool: whether no case imported a heavy module it may not import or exceeded `max_seconds`.
+    """
+    environment = dict(os.environ, PYTHONPATH=os.path.abspath(properties["SRC_DIR"]), MPLBACKEND="Agg")
+    passed = True
+    for name, script, arguments, allowed in cases:
+        results = []
+        for _ in range(repeats):
+            start = time.time()
+            process = subprocess.run([sys.executable, "-c", STARTUP_PROBE.format(STARTUP_MARKER, HEAVY_MODULES),
+                                      script] + arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     universal_newlines=True, env=environment)
+            report = [line for line in process.stderr.splitlines() if line.startswith(STARTUP_MARKER)]
+            if process.returncode != 0 or not report:
+                print("[INFO] {} failed:\n{}".format(name, process.stderr))
+                return False
+            results.append(dict(json.loads(report[-1][len(STARTUP_MARKER):]), total=time.time() - start))
+
+        result = min(results, key=lambda result: result["total"])
+        forbidden = [module for module in result["modules"] if module not in allowed]
+        slow = max_seconds is not None and result["total"] > max_seconds
+        passed = passed and not forbidden and not slow
+        print("[INFO] {}: {:.3f}s including the interpreter, {:.3f}s in the script, heavy modules: {}{}".format(
+            name, result["total"], result["seconds"], ", ".join(result["modules"]) or "none",
+            "  [FAIL]" if forbidden or slow else ""))
+    return passed
+
+
+def synthetic_assets(directory, seed=0):
+    """Writes random images and masks in the layout of `<project-root>/assets` to `directory`: the 100 images of the
+    608x608 training set, whose split assumes 100 images, 20 images of the 400x400 training set and 10 test images."""
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    for path, count, size in (("608/training", 100, 608), ("400/training", 20, 400), ("tests", 10, 608)):
+        os.makedirs(os.path.join(directory, path, "data"))
+        if path != "tests":
+            os.makedirs(os.path.join(directory, path, "verify"))
+        for idx in range(1, count + 1):
+            name = "satImage_{:03d}.png".format(idx) if path != "tests" else "test_{}.png".format(idx)
+            Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)).save(
+                os.path.join(directory, path, "data", name))
+            if path != "tests":
+                # roads as whole patches, so that both labels occur
+                mask = rng.random((size // 16, size // 16)) < 0.3
+                Image.fromarray(np.kron(mask, np.ones((16, 16))).astype(np.uint8) * 255).save(
+                    os.path.join(directory, path, "verify", name))
+
+
+def run_pipeline_case(case, assets, batches=20, workers=0):
+    """Measures one case of the data pipeline benchmark in the current process.
+
+    Args:
+        case (str): one of `PIPELINE_CASES`.
+        assets (path): directory in the layout of `<project-root>/assets`.
+        batches (int): batches timed after one warm-up batch.
+        workers (int): threads preparing the batches of `ImageToPatchGenerator.next_batch`.
+
+    Returns:
+        dict: the case, the seconds to set it up, the batches, their size and the seconds they took, the batches per
+        second and the peak resident set size of the process in MB, or the case and the reason it was `skipped`.
+    """
+    requirement = PIPELINE_REQUIREMENTS.get(case)
+    if requirement and importlib.util.find_spec(requirement) is None:
+        return {"case": case, "skipped": "{} is not installed".format(requirement)}
+
+    with tempfile.TemporaryDirectory() as directory:
+        return _time_pipeline_case(case, assets, directory, batches, workers)
+
+
+def _time_pipeline_case(case, assets, directory, batches, workers):
+    from utils.rng import spawn_rngs, seed_sequence
+
+    rng = spawn_rngs(seed_sequence(0), 1)[0]
+    start = time.time()
+    if case in ("image_to_patch", "augment"):
+        from generators.ImageToPatchGenerator import ImageToPatchGenerator
+
+        generator = ImageToPatchGenerator(os.path.join(assets, "608/training"), None, 100, 20, False, workers=workers,
+                                          seed=0)
+        batch_size = 8
+        if case == "image_to_patch":
+            iterator = generator.next_batch("train", batch_size)
+        else:
+            def augmented():
+                while True:
+                    indices = np.sort(rng.choice(len(generator.images_train), batch_size, replace=False))
+                    yield generator.augment(generator.images_train[indices], generator.masks_train[indices], True,
+                                            rng)
+            iterator = augmented()
+
+    elif case == "patch_train":
+        from generators.PatchTrainImageGenerator import PatchTrainImageGenerator
+
+        generator = PatchTrainImageGenerator(os.path.join(assets, "400/training/data"),
+                                             os.path.join(assets, "400/training/verify"), seed=0)
+        batch_size = 100
+        iterator = generator.generate_patch(batch_size, road_fraction=0.5)
+
+    elif case == "patch_test":
+        from generators.PatchTestImageGenerator import PatchTestImageGenerator
+
+        generator = PatchTestImageGenerator(os.path.join(assets, "tests/data"), None)
+        batch_size = 38 * 38
+
+        def windows():
+            while True:
+                for image_windows in generator.generate_test_patches(copy=True):
+                    yield image_windows
+        iterator = windows()
+
+    elif case in ("submission_cnn", "submission_u_net"):
+        from models.predict_on_tests import Prediction_model
+        from utils.submission import SubmissionWriter
+
+        image_ids = ["{:03d}".format(idx) for idx in range(1, 51)]
+        batch_size = len(image_ids)
+        submission_file = os.path.join(directory, "submission.csv")
+        if case == "submission_cnn":
+            # the test generator only provides the ids and the patch size to the writer of cnn_lr_d
+            test_generator = type("TestImages", (), {"images_ids": image_ids, "patch_size": 16})
+            model = Prediction_model(test_generator, None)
+            grids = [rng.random((38, 38, 2), dtype=np.float32) for _ in image_ids]
+
+            def written():
+                while True:
+                    yield model.save_predictions_to_csv(grids, submission_file)
+        else:
+            grids = [rng.random((38, 38), dtype=np.float32) for _ in image_ids]
+
+            def written():
+                while True:
+                    with SubmissionWriter(submission_file, 16, 0.5) as writer:
+                        for image_id, grid in zip(image_ids, grids):
+                            writer.write(image_id, grid)
+                    yield
+        iterator = written()
+
+    else:
+        raise ValueError("Unknown pipeline case {}".format(case))
+
+    next(iterator)  # warm up
+    setup = time.time() - start
+    start = time.time()
+    for _ in range(batches):
+        next(iterator)
+    seconds = time.time() - start
+    return {"case": case, "setup_seconds": setup, "batches": batches, "batch_size": batch_size,
+            "seconds": seconds, "batches_per_second": batches / seconds,
+            # kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+
+
+def benchmark_pipeline(cases, assets, batches=20, workers=0):
+    """Runs the cases of the data pipeline benchmark, each in a fresh process so that their peak memory is their own.
+
+    Returns:
+        list: per case, the dict of `run_pipeline_case`, or the case and its `error` if it failed. Skipped cases do not
+        fail the run.
+    """
+    environment = dict(os.environ, PYTHONPATH=os.path.abspath(properties["SRC_DIR"]), MPLBACKEND="Agg")
+    results = []
+    for case in cases:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "pipeline", "--child", "--case", case,
+                                  "--assets", assets, "--batches", str(batches), "-w", str(workers)],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                                 env=environment)
+        report = [line for line in process.stdout.splitlines() if line.startswith(PIPELINE_MARKER)]
+        if process.returncode != 0 or not report:
+            error = (process.stderr.strip().splitlines() or ["exit code {}".format(process.returncode)])[-1]
+            results.append({"case": case, "error": error})
+            print("[INFO] {}: failed, {}".format(case, error))
+            continue
+
+        result = json.loads(report[-1][len(PIPELINE_MARKER):])
+        results.append(result)
+        if "skipped" in result:
+            print("[INFO] {}: skipped, {}".format(case, result["skipped"]))
+            continue
+        print("[INFO] {}: {:.2f} batches/s of {}, peak RSS {:.0f} MB, set up in {:.1f}s".format(
+            case, result["batches_per_second"], result["batch_size"], result["peak_rss_mb"],
+            result["setup_seconds"]))
+    return results
+
+
+def compare_pipeline(results, baseline, tolerance=0.2):
+    """Compares pipeline results with the results of an earlier run.
+
+    Returns:
+        list: the messages of the cases whose throughput dropped or whose peak memory grew by more than `tolerance`.
+    """
+    previous = {result["case"]: result for result in baseline["results"] if "batches_per_second" in result}
+    regressions = []
+    for result in results:
+        if "batches_per_second" not in result or result["case"] not in previous:
+            continue
+        before = previous[result["case"]]
+        if result["batches_per_second"] < (1 - tolerance) * before["batches_per_second"]:
+            regressions.append("{}: {:.2f} batches/s, was {:.2f}".format(
+                result["case"], result["batches_per_second"], before["batches_per_second"]))
+        if result["peak_rss_mb"] > (1 + tolerance) * before["peak_rss_mb"]:
+            regressions.append("{}: peak RSS {:.0f} MB, was {:.0f}".format(
+                result["case"], result["peak_rss_mb"], before["peak_rss_mb"]))
+    return regressions
+
+
+def _setup_argparser():
+    """Sets up the argument parser and returns the arguments.
+
+    Returns:
+        argparse.Namespace: The command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks of the prediction paths.")
+    parser.add_argument("benchmark", choices=["tta", "fcn", "startup", "pipeline"],
+                        help="tta: latency and validation scores with and without test-time augmentation, "
+                             "fcn: latency and predictions of cnn_lr_d per window and fully convolutional, "
+                             "startup: startup time and heavy imports of the actions not running a model, "
+                             "pipeline: batches per second and peak memory of the generators and submission writers")
+    parser.add_argument("-m", "--model", action="store",
+                        choices=["u_net", "u_net_dropout"],
+                        default="u_net_dropout",
+                        type=str,
+                        help="the CNN model of the tta benchmark, its latest run is restored")
+    parser.add_argument("-bs", "--batch_size",
+                        help="tiles (u_net) or patches (cnn_lr_d) per model call",
+                        action="store",
+                        default=None,
+                        type=int)
+    parser.add_argument("--overlap",
+                        help="overlap in pixels of the tiles of large images",
+                        action="store",
+                        default=64,
+                        type=int)
+    parser.add_argument("-d", "--data",
+                        help="path to the images predicted by the fcn benchmark",
+                        action="store",
+                        default=os.path.join(properties["TEST_DIR"], "data"),
+                        type=str)
+    parser.add_argument("--assets",
+                        help="images of the pipeline benchmark: synthetic, real for <project-root>/assets, or a "
+                             "directory in the same layout",
+                        action="store",
+                        default="synthetic",
+                        type=str)
+    parser.add_argument("--case",
+                        help="pipeline cases to run, defaults to all",
+                        action="store",
+                        nargs="+",
+                        choices=PIPELINE_CASES,
+                        default=list(PIPELINE_CASES))
+    parser.add_argument("--child",
+                        help=argparse.SUPPRESS,
+                        action="store_true")
+    parser.add_argument("--batches",
+                        help="batches timed per pipeline case",
+                        action="store",
+                        default=20,
+                        type=int)
+    parser.add_argument("-w", "--workers",
+                        help="threads preparing the batches of the u_net generator in the pipeline benchmark",
+                        action="store",
+                        default=0,
+                        type=int)
+    parser.add_argument("-o", "--output",
+                        help="JSON file the pipeline results are written to",
+                        action="store",
+                        default=None,
+                        type=str)
+    parser.add_argument("--baseline",
+                        help="JSON results of an earlier pipeline run, exits with an error on regressions",
+                        action="store",
+                        default=None,
+                        type=str)
+    parser.add_argument("--tolerance",
+                        help="relative drop of throughput or growth of peak memory tolerated by --baseline",
+                        action="store",
+                        default=0.2,
+                        type=float)
+    parser.add_argument("--max_seconds",
+                        help="startup time above which a startup case fails",
+                        action="store",
+                        default=None,
+                        type=float)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _setup_argparser()
+
+    if args.benchmark == "tta":
+        from generators.ImageToPatchGenerator import ImageToPatchGenerator, TRAIN_VALID_SPLIT
+        from models import u_net_pixel_to_patch
+
+        properties["OUTPUT_DIR"] = latest_run(args.model)
+        model = u_net_pixel_to_patch.UNet(None, path=os.path.join(properties["OUTPUT_DIR"], "weights.h5"),
+                                          type="normal" if args.model == "u_net" else "dropout")
+        image_files, mask_files = ImageToPatchGenerator.dataset_files(properties["TRAIN_DIR_608"], "valid",
+                                                                      TRAIN_VALID_SPLIT)
+        benchmark_tta(model, image_files, mask_files, overlap=args.overlap, batch_size=args.batch_size)
+
+    elif args.benchmark == "fcn":
+        from generators.PatchTestImageGenerator import PatchTestImageGenerator
+        from models import cnn_lr_d
+
+        properties["OUTPUT_DIR"] = latest_run("cnn_lr_d")
+        test_generator = PatchTestImageGenerator(path_to_images=args.data, save_predictions_path=None)
+        model_class = cnn_lr_d.CnnLrD(test_generator, path=os.path.join(properties["OUTPUT_DIR"], "weights.h5"))
+        benchmark_fcn(model_class, test_generator, batch_size=args.batch_size or 512)
+
+    elif args.benchmark == "startup":
+        with tempfile.TemporaryDirectory() as directory:
+            passed = benchmark_startup(startup_cases(directory), max_seconds=args.max_seconds)
+        sys.exit(0 if passed else 1)
+
+    elif args.benchmark == "pipeline":
+        if args.child:
+            # a single case in the process started by `benchmark_pipeline`
+            print(PIPELINE_MARKER + json.dumps(run_pipeline_case(args.case[0], args.assets, args.batches,
+                                                                 args.workers)))
+            sys.exit(0)
+
+        with tempfile.TemporaryDirectory() as directory:
+            if args.assets == "synthetic":
+                print("[INFO] Writing synthetic assets to {}".format(directory))
+                synthetic_assets(directory)
+                assets = directory
+            else:
+                assets = os.path.abspath(os.path.join(properties["SRC_DIR"], "../assets")
+                                         if args.assets == "real" else args.assets)
+            results = benchmark_pipeline(args.case, assets, args.batches, args.workers)
+
+        report = {"assets": args.assets, "batches": args.batches, "workers": args.workers,
+                  "python": platform.python_version(), "numpy": np.__version__, "cpus": os.cpu_count(),
+                  "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(report, file, indent=2)
+            print("[INFO] Results written to {}".format(args.output))
+        else:
+            print(json.dumps(report, indent=2))
+
+        failed = any("error" in result for result in results)
+        if args.baseline:
+            with open(args.baseline) as file:
+                regressions = compare_pipeline(results, json.load(file), args.tolerance)
+            for regression in regressions:
+                print("[INFO] Regression in {}".format(regression))
+            failed = failed or bool(regressions)
+        sys.exit(1 if failed else 0)
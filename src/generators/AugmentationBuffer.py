@@ -0,0 +1,150 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from utils.storage import cast
+
+# Keras draws the transformations from the global np.random state, which it reseeds, so the draws of all buffers and
+# generators of the process are serialized
+_transform_lock = threading.Lock()
+
+
+def augment_images(images, masks, seed):
+    """Applies the same random affine transformation to each image and its mask.
+
+    The transformation of each image is drawn once, from its own seed derived from `seed`, and applied to the image and
+    to its mask, so concurrent augmentations neither mix up the transformations of an image and its mask nor depend on
+    each other.
+
+    Args:
+        images (np.ndarray): (n, height, width, 3) images.
+        masks (np.ndarray): (n, height, width) masks.
+        seed (int): seed of the transformations.
+
+    Returns:
+        (np.ndarray, np.ndarray): the augmented float32 images and masks.
+    """
+    # imported here so that listing the dataset files does not import keras
+    from keras.preprocessing.image import ImageDataGenerator
+
+    datagen = ImageDataGenerator(
+        width_shift_range=0.1,
+        height_shift_range=0.1,
+        rotation_range=360,
+        shear_range=0.1,
+        zoom_range=0.2,
+        fill_mode="reflect"
+    )
+
+    seeds = np.random.default_rng(seed).integers(2 ** 31 - 1, size=len(images))
+    images_augmented = np.empty(images.shape, dtype=np.float32)
+    masks_augmented = np.empty(masks.shape, dtype=np.float32)
+    for idx in range(len(images)):
+        image = images[idx].astype(np.float32)
+        mask = masks[idx].reshape(masks.shape[1:] + (1,)).astype(np.float32)
+        if hasattr(datagen, "get_random_transform"):
+            with _transform_lock:
+                transform = datagen.get_random_transform(image.shape, seed=int(seeds[idx]))
+            image, mask = datagen.apply_transform(image, transform), datagen.apply_transform(mask, transform)
+        else:
+            # Keras before 2.2 draws and applies a transformation in one call, reseeded identically for the mask
+            with _transform_lock:
+                image = datagen.random_transform(image, seed=int(seeds[idx]))
+                mask = datagen.random_transform(mask, seed=int(seeds[idx]))
+        images_augmented[idx] = image
+        masks_augmented[idx] = mask.reshape(masks.shape[1:])
+
+    return images_augmented, masks_augmented
+
+
+class AugmentationBuffer(object):
+    """Pool of augmented copies of a set of images, refreshed a chunk at a time.
+
+    Instead of re-augmenting the whole set at once, a call to `step` swaps in the chunk augmented since the previous
+    refresh and starts augmenting the next chunk on a background thread. Refreshes happen every step or every few
+    steps, so that on average `refresh_fraction` of the pool is renewed per step. The pool is updated in place, so memory
+    stays at one augmented copy of the pool plus one chunk. Only the patch labels of the augmented masks are kept.
+
+    By default the pool holds a copy of every image. With a smaller `pool_size`, e.g. for a sharded dataset which does
+    not fit in memory, each chunk is drawn at random from the whole set instead.
+    """
+
+    def __init__(self, images, masks, augmentation, refresh_fraction, rng, label_index, pool_size=None):
+        """Initialise the pool with an augmented copy of every image, or of `pool_size` random images.
+
+        Args:
+            images (np.ndarray): (n, height, width, 3) source images, in a storage dtype, or a
+                `utils.sharded_dataset.ShardedArray`.
+            masks (np.ndarray): (n, height, width) source masks, in a storage dtype.
+            augmentation (bool): augment the images, if False and the pool holds every image, the pool is the source
+                set and never changes.
+            refresh_fraction (float): fraction of the pool re-augmented per step on average, e.g. 1 / steps per epoch
+                renews the pool once per epoch. Fractions below one image per step refresh one image every few steps.
+            rng (np.random.Generator): source of the augmentation seeds and of the images drawn into the pool.
+            label_index (callable): maps masks to their `PatchLabelIndex`, which is kept up to date with the masks of
+                the pool.
+            pool_size (int): number of images in the pool, defaults to all images.
+        """
+        self.images = images
+        self.masks = masks
+        self.augmentation = augmentation
+        self.rng = rng
+        self.pool_size = min(pool_size or len(images), len(images))
+        # a partial pool is refreshed with other images even without augmentation
+        self.refreshing = augmentation or self.pool_size < len(images)
+        self.refresh_rate = refresh_fraction * self.pool_size
+        self.chunk_size = min(self.pool_size, max(1, int(round(self.refresh_rate))))
+        # images due for a refresh, carried across steps so that the fractional remainder is not rounded away
+        self.due = 0.
+        self.cursor = 0
+        self.pending = None
+
+        if self.refreshing:
+            self.pool_images = np.empty((self.pool_size,) + images.shape[1:], dtype=images.dtype)
+            self.label_index = label_index(np.zeros((self.pool_size,) + masks.shape[1:], dtype=masks.dtype))
+            for _ in range(0, self.pool_size, self.chunk_size):
+                self.swap(*self.augment_chunk(*self.next_chunk()))
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        else:
+            self.pool_images = images
+            self.label_index = label_index(masks)
+
+    def __len__(self):
+        return len(self.pool_images)
+
+    def step(self):
+        """Swaps in the chunk augmented since the last refresh and starts augmenting the next one, once a chunk of
+        images is due."""
+        if not self.refreshing:
+            return
+        self.due += self.refresh_rate
+        if self.due < self.chunk_size:
+            return
+        self.due -= self.chunk_size
+        if self.pending is not None:
+            self.swap(*self.pending.result())
+        self.pending = self.executor.submit(self.augment_chunk, *self.next_chunk())
+
+    def gather(self, indices):
+        """Returns copies of the pooled images and of their patch labels at `indices`."""
+        return self.pool_images[indices], self.label_index.labels[indices]
+
+    def next_chunk(self):
+        slots = (self.cursor + np.arange(self.chunk_size)) % self.pool_size
+        self.cursor = (self.cursor + self.chunk_size) % self.pool_size
+        if self.pool_size == len(self.images):
+            sources = slots
+        else:
+            sources = np.sort(self.rng.choice(len(self.images), self.chunk_size, replace=False))
+        return slots, sources, int(self.rng.integers(100000))
+
+    def augment_chunk(self, slots, sources, seed):
+        images, masks = self.images[sources], self.masks[sources]
+        if self.augmentation:
+            images, masks = augment_images(images, masks, seed)
+        return slots, cast(images, self.images.dtype), cast(masks, self.masks.dtype)
+
+    def swap(self, slots, images, masks):
+        self.pool_images[slots] = images
+        self.label_index.update(slots, masks)
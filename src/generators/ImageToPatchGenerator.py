@@ -1,28 +1,78 @@
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from keras.preprocessing.image import ImageDataGenerator
-from scipy.ndimage import imread
+
+from generators.AugmentationBuffer import AugmentationBuffer, augment_images
+from generators.PatchLabelIndex import PatchLabelIndex
+from utils.dataset_cache import decode_images, load_dataset
+from utils.rng import seed_sequence, spawn_rngs, substreams
+from utils.sharded_dataset import ShardedDataset
+from utils.storage import to_model, value_scale
+
+# fraction of the 100 training images in the training split, the rest is the validation split
+TRAIN_VALID_SPLIT = 0.92
 
 
 class ImageToPatchGenerator(object):
-    def __init__(self, path_to_data, path_to_test, steps_per_epoch, validation_steps, augmentation, train_valid_split=0.92):
+    def __init__(self, path_to_data, path_to_test, steps_per_epoch, validation_steps, augmentation,
+                 train_valid_split=TRAIN_VALID_SPLIT, workers=0, queue_size=8, seed=None, refresh_fraction=None,
+                 dtype="uint8", cache_dir=None, processes=None, dataset_dir=None, pool_size=None, cache_shards=16):
+        """Initialise the generator.
+
+        Args:
+            workers (int): number of threads preparing batches in the background, 0 prepares them on the caller's
+                thread.
+            queue_size (int): number of batches prepared ahead of the consumer when using workers.
+            seed (int): seed of all random draws, batches are reproducible for a given seed whatever the number of
+                workers, see `utils.rng`.
+            refresh_fraction (float): fraction of the augmented images replaced per batch, defaults to renewing the
+                whole set once per `steps_per_epoch` (resp. `validation_steps`) batches.
+            dtype (str): storage dtype of the images and masks, see `utils.storage`. Batches are always float32.
+            cache_dir (path): if given, the images and masks are memory-mapped from this dataset cache, see
+                `utils.dataset_cache`.
+            processes (int): number of processes decoding the images and masks not cached yet, defaults to the number
+                of CPUs, see `utils.dataset_cache.decode_images`.
+            dataset_dir (path): if given, the images and masks are read from the sharded datasets `train` and `valid`
+                in this directory instead, see `utils.sharded_dataset`. They must be unpadded and stored as `dtype`.
+            pool_size (int): number of augmented images held in memory per split, drawn from the whole split, defaults
+                to all images.
+            cache_shards (int): number of shards of each sharded dataset kept open.
+        """
         self.input_size = 608
         self.patch_size = 16
         self.foreground_threshold = 0.25
-
-        self.images_train, self.masks_train = self.load_images(path_to_data, self.input_size, "train", train_valid_split)
-        self.images_valid, self.masks_valid = self.load_images(path_to_data, self.input_size, "valid", train_valid_split)
-
-        if augmentation:
-            self.images_train_pre, self.masks_train_pre = self.augment(self.images_train, self.masks_train, augmentation)
-            self.images_valid_pre, self.masks_valid_pre = self.augment(self.images_valid, self.masks_valid, augmentation)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.dtype = dtype
+        self.seed_sequence = seed_sequence(seed)
+        # all streams are spawned up front, so that the batches of a split do not depend on the order the splits are
+        # first drawn from, nor on calls to `augment`
+        train_rng, valid_rng, self.augment_rng = spawn_rngs(self.seed_sequence, 3)
+        # one substream per batch of each split, drawn in scheduling order
+        self.batch_rngs = dict(zip(("train", "valid"), (substreams(sequence)
+                                                        for sequence in self.seed_sequence.spawn(2))))
+
+        if dataset_dir:
+            train_set = ShardedDataset(os.path.join(dataset_dir, "train"), cache_shards)
+            valid_set = ShardedDataset(os.path.join(dataset_dir, "valid"), cache_shards)
+            for dataset in (train_set, valid_set):
+                dataset.check(0, dtype)
+            self.images_train, self.masks_train = train_set.images, train_set.masks
+            self.images_valid, self.masks_valid = valid_set.images, valid_set.masks
         else:
-            self.images_train_pre, self.masks_train_pre = self.images_train, self.masks_train
-            self.images_valid_pre, self.masks_valid_pre = self.images_valid, self.masks_valid
-
-        self.train_counter = 0
-        self.valid_counter = 0
+            self.images_train, self.masks_train = self.load_images(path_to_data, "train", train_valid_split, dtype,
+                                                                   cache_dir, processes)
+            self.images_valid, self.masks_valid = self.load_images(path_to_data, "valid", train_valid_split, dtype,
+                                                                   cache_dir, processes)
+
+        self.train_buffer = AugmentationBuffer(self.images_train, self.masks_train, augmentation,
+                                               refresh_fraction or 1. / steps_per_epoch,
+                                               train_rng, self.label_index, pool_size)
+        self.valid_buffer = AugmentationBuffer(self.images_valid, self.masks_valid, augmentation,
+                                               refresh_fraction or 1. / validation_steps,
+                                               valid_rng, self.label_index, pool_size)
 
         self.steps_per_epoch = steps_per_epoch
         self.validation_steps = validation_steps
@@ -30,55 +80,66 @@ class ImageToPatchGenerator(object):
         self.augmentation = augmentation
 
     def next_batch(self, type="train", batch_size=8):
-        while True:
-            if type == "valid":
-                image_set = self.images_valid_pre
-                masks_set = self.masks_valid_pre
-                if self.valid_counter == self.validation_steps - 1:
-                    self.images_valid_pre, self.masks_valid_pre = self.augment(self.images_valid, self.masks_valid, self.augmentation)
-                    self.valid_counter = 0
-                else:
-                    self.valid_counter = self.valid_counter + 1
+        """Yields batches of (images, patch masks) endlessly.
+
+        With `workers` > 0, the batches are prepared by a thread pool, at most `queue_size` ahead of the consumer, and
+        are yielded in the order they were scheduled.
+        """
+        buffer = self.valid_buffer if type == "valid" else self.train_buffer
+        # drawn in scheduling order, so the batches do not depend on the workers
+        batch_rngs = self.batch_rngs["valid" if type == "valid" else "train"]
+
+        def schedule():
+            buffer.step()
+            rng = next(batch_rngs)
+            images, masks = buffer.gather(rng.choice(len(buffer), batch_size))
+            return images, masks, rng
 
-            else:
-                image_set = self.images_train_pre
-                masks_set = self.masks_train_pre
-                if self.train_counter == self.steps_per_epoch - 1:
-                    self.images_train_pre, self.masks_train_pre = self.augment(self.images_train, self.masks_train, self.augmentation)
-                    self.train_counter = 0
-                else:
-                    self.train_counter = self.train_counter + 1
+        if self.workers == 0:
+            while True:
+                yield self.make_batch(*schedule())
 
-            images = np.empty((batch_size, self.input_size, self.input_size, 3))
-            masks = np.empty((batch_size, self.input_size // self.patch_size, self.input_size // self.patch_size))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            while True:
+                while len(pending) < self.queue_size:
+                    pending.append(executor.submit(self.make_batch, *schedule()))
+                yield pending.popleft().result()
 
-            random_indices = np.random.choice(len(image_set), batch_size)
-            random_rotation = np.random.choice(4, batch_size)
+    def label_index(self, masks):
+        """Returns the index of the labels of the patch grid of the given masks."""
+        return PatchLabelIndex(masks, self.patch_size, self.foreground_threshold, stride=self.patch_size,
+                               scale=value_scale(masks.dtype))
 
-            random_flip = np.random.choice(2, batch_size)
+    def make_batch(self, images_set, masks_set, rng):
+        """Randomly rotates and flips the given images and their (rows, columns) grids of patch labels."""
+        batch_size = len(images_set)
+        images = np.empty((batch_size, self.input_size, self.input_size, 3), dtype=np.float32)
+        masks = np.empty((batch_size, self.input_size // self.patch_size, self.input_size // self.patch_size),
+                         dtype=np.float32)
 
-            for i, idx in enumerate(random_indices):
-                image = image_set[idx]
-                mask = masks_set[idx]
+        random_rotation = rng.choice(4, batch_size)
 
-                image = np.rot90(image, random_rotation[i])
-                mask = np.rot90(mask, random_rotation[i])
+        random_flip = rng.choice(2, batch_size)
 
-                if random_flip[i] == 1:
-                    image = np.fliplr(image)
-                    mask = np.fliplr(mask)
+        for i in range(batch_size):
+            image = images_set[i]
+            mask = masks_set[i]
 
-                patches = self.extract_blocks(mask, (self.patch_size, self.patch_size))
-                mask = (patches.mean(axis=(1, 2)) > self.foreground_threshold)
-                mask = mask.reshape((608 // 16, 608 // 16))
+            image = np.rot90(image, random_rotation[i])
+            mask = np.rot90(mask, random_rotation[i])
 
-                images[i] = image
-                masks[i] = mask
+            if random_flip[i] == 1:
+                image = np.fliplr(image)
+                mask = np.fliplr(mask)
 
-            masks = masks.reshape(
-                (batch_size, self.input_size // self.patch_size, self.input_size // self.patch_size, 1))
+            to_model(image, out=images[i])
+            masks[i] = mask
 
-            yield images, masks
+        masks = masks.reshape(
+            (batch_size, self.input_size // self.patch_size, self.input_size // self.patch_size, 1))
+
+        return images, masks
 
     @staticmethod
     def extract_blocks(a, blocksize):
@@ -86,37 +147,22 @@ class ImageToPatchGenerator(object):
         b0, b1 = blocksize
         return a.reshape(M // b0, b0, N // b1, b1).swapaxes(1, 2).reshape(-1, b0, b1)
 
-    @staticmethod
-    def augment(images, masks, augmentation):
+    def augment(self, images, masks, augmentation, rng=None):
+        """Applies the same random affine transformation to images and masks if `augmentation` is set, seeded from
+        `rng`, by default from the augmentation stream of the generator."""
         if augmentation:
-            augmentation_size = len(images)
-            datagen = ImageDataGenerator(
-                width_shift_range=0.1,
-                height_shift_range=0.1,
-                rotation_range=360,
-                shear_range=0.1,
-                zoom_range=0.2,
-                fill_mode="reflect"
-            )
-
-            seed = np.random.choice(100000, 1)
-            d_images = datagen.flow(images, batch_size=augmentation_size, shuffle=False, seed=seed)
-            d_masks = datagen.flow(masks.reshape((augmentation_size, 608, 608, 1)), batch_size=augmentation_size, shuffle=False, seed=seed)
-
-            images_augmented = next(d_images)
-            masks_augmented = next(d_masks).reshape((augmentation_size, 608, 608))
-
-            return images_augmented, masks_augmented
+            rng = rng if rng is not None else self.augment_rng
+            return augment_images(images, masks, int(rng.integers(100000)))
         else:
             return images, masks
 
     @staticmethod
-    def load_images(path, input_size, type, train_valid_split):
+    def dataset_files(path, type, train_valid_split):
+        """Returns the paths of the images and masks of the training or the validation split."""
         image_files = sorted(os.listdir(os.path.join(path, 'data')))
         mask_files = sorted(
             os.listdir(os.path.join(path, 'verify')) if os.path.exists(os.path.join(path, 'verify')) else [])
 
-
         if type == "train":
             image_files = image_files[0:int(train_valid_split * 100)]
             mask_files = mask_files[0:int(train_valid_split * 100)]
@@ -124,17 +170,19 @@ class ImageToPatchGenerator(object):
             image_files = image_files[int(train_valid_split * 100):]
             mask_files = mask_files[int(train_valid_split * 100):]
 
-        images = np.zeros((len(image_files), input_size, input_size, 3))
-        for idx, image_file in enumerate(image_files):
-            image = imread(os.path.join(path, 'data', image_file))
-            images[idx, :, :, :] = image / 255.
+        return ([os.path.join(path, 'data', image_file) for image_file in image_files],
+                [os.path.join(path, 'verify', mask_file) for mask_file in mask_files])
 
-        if len(mask_files) > 0:
-            masks = np.zeros((len(image_files), input_size, input_size))
-            for idx, mask_file in enumerate(mask_files):
-                mask = imread(os.path.join(path, 'verify', mask_file))
-                masks[idx, :, :] = mask / 255.
+    @staticmethod
+    def load_images(path, type, train_valid_split, dtype="uint8", cache_dir=None, processes=None):
+        image_files, mask_files = ImageToPatchGenerator.dataset_files(path, type, train_valid_split)
 
+        if cache_dir:
+            return load_dataset(image_files, mask_files, 0, dtype, cache_dir, processes)
+
+        images = decode_images(image_files, 0, dtype, processes=processes)
+        if len(mask_files) > 0:
+            masks = decode_images(mask_files, 0, dtype, processes=processes)
         else:
             masks = []
 
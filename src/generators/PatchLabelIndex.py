@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class PatchLabelIndex(object):
+    """Road / background labels of every patch position of a set of masks.
+
+    The labels are computed once per mask from a summed-area table, after which the label of any patch is an O(1)
+    lookup and patches of a given label can be drawn directly, e.g. to sample road and background patches in a fixed
+    ratio.
+    """
+
+    def __init__(self, masks, patch_size, threshold, stride=1, scale=1):
+        """Index the given masks.
+
+        Args:
+            masks (np.ndarray): (n, height, width) masks.
+            patch_size (int): side of the square patches.
+            threshold (float): a patch is labelled road if its mean foreground is above this fraction.
+            stride (int): distance between indexed patch positions, `patch_size` only indexes the aligned patch grid.
+            scale (float): mask value of a fully foreground pixel, see `utils.storage.value_scale`.
+        """
+        n, height, width = masks.shape
+        self.patch_size = patch_size
+        self.stride = stride
+        self.min_sum = threshold * scale * patch_size * patch_size
+        self.labels = np.empty((n, (height - patch_size) // stride + 1, (width - patch_size) // stride + 1),
+                               dtype=bool)
+        self.positions = {}
+        self.update(np.arange(n), masks)
+
+    def update(self, indices, masks):
+        """Re-indexes the masks at `indices`, e.g. after they were augmented."""
+        rows = np.arange(self.labels.shape[1]) * self.stride
+        cols = np.arange(self.labels.shape[2]) * self.stride
+        p = self.patch_size
+        table = np.zeros((masks.shape[1] + 1, masks.shape[2] + 1))
+        for idx, mask in zip(indices, masks):
+            np.cumsum(np.cumsum(mask, axis=0, dtype=np.float64), axis=1, out=table[1:, 1:])
+            sums = (table[np.ix_(rows + p, cols + p)] - table[np.ix_(rows, cols + p)]
+                    - table[np.ix_(rows + p, cols)] + table[np.ix_(rows, cols)])
+            self.labels[idx] = sums > self.min_sum
+        self.positions = {}
+
+    def label(self, indices, rows, cols):
+        """Returns the labels of the patches with top left corners (rows, cols) in the masks at `indices`."""
+        return self.labels[indices, rows // self.stride, cols // self.stride]
+
+    def sample(self, label, size, rng=np.random, first=0, count=None):
+        """Draws patches with the given label uniformly among all indexed patch positions.
+
+        Args:
+            label (bool): label of the patches to draw.
+            size (int): number of patches.
+            rng: random number generator with a `choice` method, e.g. a `np.random.Generator` of the caller, see
+                `utils.rng`.
+            first (int): draw from the masks `first` to `first + count` only.
+            count (int): defaults to all masks from `first` on.
+
+        Returns:
+            (np.ndarray, np.ndarray, np.ndarray): indices of the masks and rows and columns of the top left corners.
+        """
+        if label not in self.positions:
+            self.positions[label] = np.flatnonzero(self.labels == label)
+        positions = self.positions[label]
+
+        per_mask = self.labels.shape[1] * self.labels.shape[2]
+        count = len(self.labels) - first if count is None else count
+        low, high = np.searchsorted(positions, [first * per_mask, (first + count) * per_mask])
+        if high == low:
+            raise ValueError("No patch labelled {} in masks {} to {}".format(label, first, first + count))
+
+        indices, rows, cols = np.unravel_index(positions[low + rng.choice(high - low, size)], self.labels.shape)
+        return indices, rows * self.stride, cols * self.stride
@@ -1,37 +1,157 @@
 import glob
 import os
+import queue
 import re
+import threading
 
 import matplotlib.image as mpimg
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from utils.storage import to_model, to_storage
+
+PATCH_SIZE = 16
+# context around each patch, the windows of the patches are 72x72
+CONTEXT_PADDING = 28
+
+
+def patch_windows(data_img, patch_size=PATCH_SIZE, context_padding=CONTEXT_PADDING, copy=False):
+    """Returns the context windows of all patches of an image padded by `context_padding`.
+
+    The windows are a read-only strided view on `data_img` of shape
+    (patches_over_height, patches_over_width, window_size, window_size, channels): window `[h, w]` is
+    `data_img[w * patch_size:w * patch_size + window_size, h * patch_size:h * patch_size + window_size]`.
+    Flattening the first two axes gives the patch order used in the submission
+    (see `Prediction_model.save_predictions_to_csv`).
+
+    Args:
+        data_img (np.ndarray): padded image.
+        patch_size (int): side of the patches.
+        context_padding (int): context around each patch, a window is `patch_size + 2 * context_padding` wide.
+        copy (bool): return a contiguous float32 (total_patches, window_size, window_size, channels) copy instead
+            of the view. Only needed when handing the patches to the model in one piece.
+
+    Returns:
+        (int, np.ndarray): the number of patches and the windows.
+    """
+    window_size = patch_size + 2 * context_padding
+
+    width_image, height_image, channels = data_img.shape
+    patches_over_width = (width_image - 2 * context_padding) // patch_size
+    patches_over_height = (height_image - 2 * context_padding) // patch_size
+    total_patches = patches_over_height * patches_over_width
+
+    """Test patches:
+        from the left to the right w.r.t the image width,
+        from the bottom to top w.r.t the image height (bottom is supposed to be the top of the image)
+    """
+    stride_w, stride_h, stride_c = data_img.strides
+    img_patches = as_strided(data_img,
+                             shape=(patches_over_height, patches_over_width, window_size, window_size, channels),
+                             strides=(stride_h * patch_size, stride_w * patch_size, stride_w, stride_h, stride_c),
+                             writeable=False)
+
+    if copy:
+        img_patches = to_model(img_patches).reshape((total_patches, window_size, window_size, channels))
+    return total_patches, img_patches
 
 
 class PatchTestImageGenerator:
-    def __init__(self, path_to_images, save_predictions_path, pad=28, patch_size=16, context_padding=28,
-                 four_dim=False):
+    def __init__(self, path_to_images, save_predictions_path, pad=CONTEXT_PADDING, patch_size=PATCH_SIZE,
+                 context_padding=CONTEXT_PADDING,
+                 four_dim=False, stream=False, prefetch=4, dtype="uint8"):
+        """Initialise the generator.
+
+        Args:
+            stream (bool): do not load the test set up front, decode and pad the images lazily while the patches are
+                generated instead. Memory then stays bounded by `prefetch` images regardless of the test set size.
+            prefetch (int): number of decoded images buffered ahead of the consumer when streaming.
+            dtype (str): storage dtype of the images, see `utils.storage`.
+        """
         data_files = glob.glob(os.path.join(path_to_images, "*.png"))
         self.extract_image_ids(data_files=data_files)
         image_count = len(data_files)
-        first = mpimg.imread(data_files[0])
-        """Define the 72x72x3 single patch -> 16x16 patch with context"""
-        data_set = np.empty((image_count,
-                             first.shape[0] + 2 * pad,
-                             first.shape[1] + 2 * pad,
-                             first.shape[2]))
-
-        for idx, file in enumerate(data_files):
-            data_set[idx] = np.pad(mpimg.imread(file), ((pad, pad), (pad, pad), (0, 0)), mode="reflect")
+        self.data_files = data_files
+        self.pad = pad
+        self.stream = stream
+        self.prefetch = prefetch
+        self.dtype = dtype
+
+        if stream:
+            data_set = None
+        else:
+            first = mpimg.imread(data_files[0])
+            """Define the 72x72x3 single patch -> 16x16 patch with context"""
+            data_set = np.empty((image_count,
+                                 first.shape[0] + 2 * pad,
+                                 first.shape[1] + 2 * pad,
+                                 first.shape[2]), dtype=dtype)
+
+            for idx, file in enumerate(data_files):
+                data_set[idx] = self.load_image(file)
+            print("TOTAL TESTING SET ", data_set.shape)
         self.path_to_images = path_to_images
         # TODO ubcomment the following line for short testing purposes
         # self.data_set = data_set[0:10]
         self.data_set = data_set
-        print("TOTAL TESTING SET ", data_set.shape)
         self.four_dim = four_dim
         self.window_size = patch_size + 2 * context_padding
         self.patch_size = patch_size
         self.context_padding = context_padding
 
-        print('PatchImageGenerator initialized with {} pictures'.format(image_count))
+        print('PatchImageGenerator initialized with {} pictures{}'.format(image_count,
+                                                                          " (streaming)" if stream else ""))
+
+    def load_image(self, file):
+        """Reads a test image and pads it with the context of the border patches."""
+        return to_storage(np.pad(mpimg.imread(file), ((self.pad, self.pad), (self.pad, self.pad), (0, 0)),
+                                 mode="reflect"), self.dtype)
+
+    def images(self):
+        """Yields the padded test images in the order of `images_ids`.
+
+        When streaming, the images are decoded by a background thread into a queue holding at most `prefetch` of
+        them, so decoding overlaps with the consumer.
+        """
+        if not self.stream:
+            for img in self.data_set:
+                yield img
+            return
+
+        buffer = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for file in self.data_files:
+                    if not put(self.load_image(file)):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
 
     def extract_image_ids(self, data_files):
 
@@ -48,67 +168,19 @@ class PatchTestImageGenerator:
         check_result = (w_img - 2 * padding) / patch_size == 0 and (h_img - 2 * padding) / patch_size
         return check_result
 
-    def get_test_patches_from_image(self, data_img):
-        window_size = self.window_size
-        patch_size = self.patch_size
-        context_padding = self.context_padding
-
-        dimensions = list(data_img.shape)
-        width_image = dimensions[0]
-        height_image = dimensions[1]
-
-        """check_result = self.check_dimensions_patch_with_img(width_image, height_image, context_padding)
-        
-        if not check_result:
-            print("The width of the image ",width_image," and the height of the image", height_image,
-                   " are incompatible with patch size ", patch_size)
-            traceback.print_exc(file=sys.stdout)
-            sys.exit(0)"""
-        print("Parameters' checks:")
-        print("Width padded image ", width_image)
-        print("Height padded image ", height_image)
-        patches_over_width = int((width_image - 2 * context_padding) / patch_size)
-        print("Patches over width ", patches_over_width)
-        patches_over_height = int((height_image - 2 * context_padding) / patch_size)
-        print("Patches over height ", patches_over_height)
-        total_patches = patches_over_height * patches_over_width
-        print("Patch size ", patch_size)
-
-        """Test patches:
-            from the left to the right w.r.t the image width,
-            from the bottom to top w.r.t the image height (bottom is supposed to be the top of the image)
-        """
-        img_patches = []
-
-        for patch_h_idx in range(patches_over_height):
+    def get_test_patches_from_image(self, data_img, copy=False):
+        """Returns the context windows of all patches of a padded image, see `patch_windows`."""
+        return patch_windows(data_img, self.patch_size, self.context_padding, copy=copy)
 
-            for patch_w_idx in range(patches_over_width):
+    def generate_test_patches(self, copy=False):
+        """Yields the patches of every test image, see `get_test_patches_from_image`."""
+        for img in self.images():
+            total_patches, img_patches = self.get_test_patches_from_image(img, copy=copy)
 
-                start_w = patch_w_idx * patch_size
-                end_w = patch_w_idx * patch_size + patch_size + context_padding * 2
-                start_h = patch_h_idx * patch_size
-                end_h = patch_h_idx * patch_size + patch_size + context_padding * 2
+            if self.four_dim:
+                img_patches = img_patches[..., np.newaxis]
 
-                img_patches.append(data_img[start_w:end_w, start_h:end_h, :])
-        print("Total patches: ", total_patches)
-        return total_patches, np.asarray(img_patches)
-
-    def generate_test_patches(self):
-        while True:
-            img_number = 1
-            for img in self.data_set:
-                total_patches, img_patches = self.get_test_patches_from_image(img)
-
-                if self.four_dim:
-                    patch_idx = 0
-                    for patch in img_patches:
-                        img_patches[patch_idx] = patch.reshape(total_patches, self.window_size, self.window_size, 3, 1)
-                        patch_idx = patch_idx + 1
-                print("Patches of the image number ", img_number, " created..")
-                img_number = img_number + 1
-
-                yield img_patches
-            break
+            yield img_patches
 
     def input_dim(self):
         if self.four_dim:
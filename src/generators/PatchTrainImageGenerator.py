@@ -1,43 +1,81 @@
 import glob
 import os
 
-import keras
-import matplotlib.image as mpimg
 import numpy as np
 
+from generators.PatchLabelIndex import PatchLabelIndex
+from utils.dataset_cache import decode_images, load_dataset
+from utils.rng import seed_sequence, spawn_rngs
+from utils.sharded_dataset import ShardedDataset
+from utils.storage import to_model
 
-class PatchTrainImageGenerator:
-    def __init__(self, path_to_images, path_to_groundtruth, window_size=72, patch_size=16, threshold=0.25):
-        padding = (window_size - patch_size) // 2
-
-        data_files = sorted(glob.glob(os.path.join(path_to_images, "*.png")))
-        mask_files = sorted(glob.glob(os.path.join(path_to_groundtruth, "*.png")))
-        self.check_ids_order(data_files, mask_files)
-        image_count = len(data_files)
-        first = mpimg.imread(data_files[0])
-
-        data_set = np.empty((image_count,
-                             first.shape[0] + 2 * padding,
-                             first.shape[1] + 2 * padding,
-                             first.shape[2]))
-        verifier_set = np.empty((image_count, first.shape[0] + 2 * padding, first.shape[1] + 2 * padding))
+WINDOW_SIZE = 72
+PATCH_SIZE = 16
 
-        for idx, (file, mask_file) in enumerate(zip(data_files, mask_files)):
-            data_set[idx] = np.pad(mpimg.imread(file), ((padding, padding), (padding, padding), (0, 0)), mode="reflect")
-            verifier_set[idx] = np.pad(mpimg.imread(mask_file), ((padding, padding), (padding, padding)),
-                                       mode="reflect")
 
-        verifier_set = verifier_set / verifier_set.max()  # normalize data
+class PatchTrainImageGenerator:
+    def __init__(self, path_to_images, path_to_groundtruth, window_size=WINDOW_SIZE, patch_size=PATCH_SIZE,
+                 threshold=0.25, dtype="uint8", cache_dir=None, processes=None, dataset_dir=None, cache_shards=16,
+                 seed=None):
+        """Initialise the generator.
+
+        Args:
+            dtype (str): storage dtype of the images and ground truths, see `utils.storage`. Batches are always float32.
+            cache_dir (path): if given, the padded images and ground truths are memory-mapped from this dataset cache,
+                see `utils.dataset_cache`.
+            processes (int): number of processes decoding the images and ground truths not cached yet, defaults to
+                the number of CPUs, see `utils.dataset_cache.decode_images`.
+            dataset_dir (path): if given, the padded images are read from this sharded dataset instead, see
+                `utils.sharded_dataset`. Its ground truths are read into memory to index their patch labels. It must
+                be padded for `window_size` and stored as `dtype`.
+            cache_shards (int): number of shards of the sharded dataset kept open.
+            seed (int): seed of all random draws, see `utils.rng`. The generators returned by `generate_patch` draw
+                from one stream per split, spawned here, so the batches of a split do not depend on the other.
+        """
+        padding = self.context_padding(window_size, patch_size)
+
+        if dataset_dir:
+            dataset = ShardedDataset(dataset_dir, cache_shards)
+            dataset.check(padding, dtype)
+            data_set, verifier_set = dataset.images, dataset.masks[:]
+        else:
+            data_files, mask_files = self.dataset_files(path_to_images, path_to_groundtruth)
+            self.check_ids_order(data_files, mask_files)
+            if cache_dir:
+                data_set, verifier_set = load_dataset(data_files, mask_files, padding, dtype, cache_dir, processes)
+            else:
+                data_set = decode_images(data_files, padding, dtype, processes=processes)
+                verifier_set = decode_images(mask_files, padding, dtype, processes=processes)
+        image_count = len(data_set)
 
         self.data_set = data_set
         self.verifier_set = verifier_set
+        self.verifier_max = verifier_set.max()  # the ground truths are normalized by their maximum
+        # labels of the ground truth patches at the center of every possible window
+        self.label_index = PatchLabelIndex(verifier_set[:, padding:verifier_set.shape[1] - padding,
+                                                        padding:verifier_set.shape[2] - padding],
+                                           patch_size, threshold, scale=self.verifier_max)
         self.patch_size = patch_size
         self.window_size = window_size
         self.padding = padding
         self.threshold = threshold
+        self.seed_sequence = seed_sequence(seed)
+        # spawned up front, so that the batches of a split do not depend on the order the splits are first drawn from
+        self.rngs = dict(zip(("train", "valid"), spawn_rngs(self.seed_sequence, 2)))
 
         print('PatchImageGenerator initialized with {} pictures'.format(image_count))
 
+    @staticmethod
+    def context_padding(window_size=WINDOW_SIZE, patch_size=PATCH_SIZE):
+        """Returns the padding around each image, the context of the windows centered on its border patches."""
+        return (window_size - patch_size) // 2
+
+    @staticmethod
+    def dataset_files(path_to_images, path_to_groundtruth):
+        """Returns the sorted paths of the images and of their ground truths."""
+        return (sorted(glob.glob(os.path.join(path_to_images, "*.png"))),
+                sorted(glob.glob(os.path.join(path_to_groundtruth, "*.png"))))
+
     def check_ids_order(self, data_files, mask_files):
         total_files = len(data_files)
         for file_idx in range(total_files):
@@ -52,7 +90,14 @@ class PatchTrainImageGenerator:
 
         print("Matches completed END")
 
-    def generate_patch(self, batch_size=100, four_dim=False, augmentation=True, type="train", train_split=0.66):
+    def generate_patch(self, batch_size=100, four_dim=False, augmentation=True, type="train", train_split=0.66,
+                       road_fraction=None):
+        """Yields batches of (windows, one-hot labels of the center patches) endlessly.
+
+        Args:
+            road_fraction (float): if given, each batch holds this fraction of windows centered on a road patch and
+                the rest on a background patch, instead of windows drawn uniformly.
+        """
 
         # used for train validation split
         dataset_size = int(self.data_set.shape[0] * train_split)
@@ -63,47 +108,73 @@ class PatchTrainImageGenerator:
 
         window_size = self.window_size
         patch_size = self.patch_size
+        height, width = self.data_set.shape[1:3]
+        window_rows, window_cols = self.window_offsets(window_size, augmentation)
+        # offset from the top left corner of a center patch in the label index to the center in the padded image
+        center_offset = window_size // 2
+        one_hot = np.eye(2, dtype=np.float32)
+        rng = self.rngs["train" if type == "train" else "valid"]
         while True:
-            batch_data = np.empty((batch_size, window_size, window_size, 3))
-            batch_verifier = np.empty((batch_size, 2))
-
-            for idx in range(batch_size):
-                img_num = np.random.choice(dataset_size) + adder
-                image = self.data_set[img_num]
-                ground_truth = self.verifier_set[img_num]
-
-                # Sample a random window from the image
-                center = np.random.randint(window_size // 2, image.shape[0] - window_size // 2, 2)
-                sub_image = image[center[0] - window_size // 2:center[0] + window_size // 2,
-                            center[1] - window_size // 2:center[1] + window_size // 2]
-                gt_sub_image = ground_truth[center[0] - patch_size // 2:center[0] + patch_size // 2,
-                               center[1] - patch_size // 2:center[1] + patch_size // 2]
-
-                label = (np.array([np.mean(gt_sub_image)]) > self.threshold) * 1
-
-                if augmentation:
-                    # Image augmentation
-                    # Random flip
-                    if np.random.choice(2) == 0:
-                        # Flip vertically
-                        sub_image = np.flipud(sub_image)
-                    if np.random.choice(2) == 0:
-                        # Flip horizontally
-                        sub_image = np.fliplr(sub_image)
-
-                    # Random rotation in steps of 90°
-                    num_rot = np.random.choice(4)
-                    sub_image = np.rot90(sub_image, num_rot)
-
-                label = keras.utils.to_categorical(label, num_classes=2)
-                batch_data[idx] = sub_image
-                batch_verifier[idx] = label
+            # Sample random windows from the images, all at once
+            if road_fraction is None:
+                img_num = rng.choice(dataset_size, batch_size) + adder
+                center_rows = rng.integers(window_size // 2, height - window_size // 2, batch_size)
+                center_cols = rng.integers(window_size // 2, width - window_size // 2, batch_size)
+                labels = self.label_index.label(img_num, center_rows - center_offset, center_cols - center_offset)
+            else:
+                road_count = int(round(road_fraction * batch_size))
+                road = self.label_index.sample(True, road_count, rng, adder, dataset_size)
+                background = self.label_index.sample(False, batch_size - road_count, rng, adder, dataset_size)
+                img_num, center_rows, center_cols = [np.concatenate(x) for x in zip(road, background)]
+                center_rows = center_rows + center_offset
+                center_cols = center_cols + center_offset
+                labels = np.arange(batch_size) < road_count
+            # Image augmentation: random flips and rotations in steps of 90° of the windows
+            transforms = rng.choice(len(window_rows), batch_size)
+
+            sub_images = self.data_set[img_num[:, None, None],
+                                       center_rows[:, None, None] + window_rows[transforms],
+                                       center_cols[:, None, None] + window_cols[transforms]]
+
+            batch_data = to_model(sub_images)
+            batch_verifier = one_hot[labels.astype(np.intp)]
 
             if four_dim:
                 batch_data = batch_data.reshape(batch_size, self.window_size, self.window_size, 3, 1)
 
             yield (batch_data, batch_verifier)
 
+    @staticmethod
+    def window_offsets(window_size, augmentation=True):
+        """Returns the pixel offsets of a window from its center, for each flip and rotation of the window.
+
+        Indexing an image with `center + offsets` of transform `t` gives the window already flipped and rotated, so
+        augmented windows are gathered in a single indexing operation.
+
+        Returns:
+            (np.ndarray, np.ndarray): (transforms, window_size, window_size) row and column offsets, the identity
+            first. With augmentation, the 16 combinations of a vertical flip, a horizontal flip and a rotation.
+        """
+        rows, cols = np.meshgrid(np.arange(window_size) - window_size // 2, np.arange(window_size) - window_size // 2,
+                                 indexing="ij")
+        if not augmentation:
+            return rows[None], cols[None]
+
+        window_rows = []
+        window_cols = []
+        for flip_vertically in (False, True):
+            for flip_horizontally in (False, True):
+                for num_rot in range(4):
+                    offsets = np.stack([rows, cols], axis=-1)
+                    if flip_vertically:
+                        offsets = np.flipud(offsets)
+                    if flip_horizontally:
+                        offsets = np.fliplr(offsets)
+                    offsets = np.rot90(offsets, num_rot)
+                    window_rows.append(offsets[..., 0])
+                    window_cols.append(offsets[..., 1])
+        return np.stack(window_rows), np.stack(window_cols)
+
     def input_dim(self, four_dim=False):
         if four_dim:
             return self.window_size, self.window_size, 3, 1
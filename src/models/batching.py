@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import asyncio
+import threading
+import time
+
+
+class AsyncBatcher(object):
+    """Dynamic batching of prediction requests in front of a model.
+
+    Requests are queued on an asyncio event loop. The batcher waits for a first request, collects further requests
+    until `max_batch_size` are pending or `max_latency` seconds have passed since the first one, runs them through
+    `predict` in one call and resolves the future of each request with its prediction. `predict` runs in a thread of
+    the loop's default executor, one batch at a time, so requests keep being queued while a batch is predicted.
+
+    Within a coroutine on the loop running `run`, requests are made with `await batcher.predict(item)`. From other
+    threads, `start` runs the batcher on a loop of its own and `submit` returns a `concurrent.futures.Future`.
+    """
+
+    def __init__(self, predict, max_batch_size=4, max_latency=0.01):
+        """Initialise the batcher.
+
+        Args:
+            predict (callable): maps a list of items, e.g. images, to the list of their predictions.
+            max_batch_size (int): maximum number of items per call to `predict`.
+            max_latency (float): maximum time in seconds a request waits for others to fill its batch.
+        """
+        self.predict_batch = predict
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.loop = None
+        self._queue = None
+        self.batches = 0
+        self.items = 0
+        self.max_queue_depth = 0
+        self.wait_time = 0.
+        self.predict_time = 0.
+
+    @property
+    def queue(self):
+        # created on first use, within the loop of the batcher
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    async def predict(self, item):
+        """Queues an item and returns its prediction once its batch ran."""
+        future = asyncio.get_event_loop().create_future()
+        self.queue.put_nowait((item, future, time.time()))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    def submit(self, item):
+        """Queues an item from any thread, see `start`.
+
+        Returns:
+            concurrent.futures.Future: resolves to the prediction of the item.
+        """
+        return asyncio.run_coroutine_threadsafe(self.predict(item), self.loop)
+
+    def start(self):
+        """Runs the batcher on a new event loop in a daemon thread."""
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run_loop():
+            asyncio.set_event_loop(self.loop)
+            self.loop.call_soon(started.set)
+            self.loop.run_until_complete(self.run())
+
+        threading.Thread(target=run_loop, daemon=True).start()
+        started.wait()
+
+    async def run(self):
+        """Predicts the queued requests batch by batch, forever."""
+        self.loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = self.loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(deadline - self.loop.time(), 0)))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.time()
+            self.batches += 1
+            self.items += len(batch)
+            self.wait_time += sum(start - queued for _, _, queued in batch)
+            try:
+                predictions = await self.loop.run_in_executor(None, self.predict_batch, [item for item, _, _ in batch])
+            except Exception as e:
+                predictions = None
+                for _, future, _ in batch:
+                    if not future.cancelled():
+                        future.set_exception(e)
+            self.predict_time += time.time() - start
+            if predictions is not None:
+                for (_, future, _), prediction in zip(batch, predictions):
+                    if not future.cancelled():
+                        future.set_result(prediction)
+
+    def metrics(self):
+        """Returns the current queue depth and statistics of the batches run so far.
+
+        Returns:
+            dict: `queue_depth` and `max_queue_depth` in requests, the number of `batches` and `items` predicted, the
+            `mean_batch_size`, the `batch_fill` as fraction of `max_batch_size`, and the `mean_wait` of a request for
+            its batch and the `mean_predict` time of a batch, in seconds.
+        """
+        batches = max(self.batches, 1)
+        return {"queue_depth": self._queue.qsize() if self._queue is not None else 0,
+                "max_queue_depth": self.max_queue_depth,
+                "batches": self.batches,
+                "items": self.items,
+                "mean_batch_size": self.items / batches,
+                "batch_fill": self.items / (batches * self.max_batch_size),
+                "mean_wait": self.wait_time / max(self.items, 1),
+                "mean_predict": self.predict_time / batches}
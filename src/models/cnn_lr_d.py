@@ -88,12 +88,14 @@ class CnnLrD(BaseModel):
 
         print("Done")
 
-    def train(self, epochs=150, steps=5000, train_split=0.66):
+    def train(self, epochs=150, steps=5000, train_split=0.66, road_fraction=None):
         """Train the model.
 
         Args:
             epochs (int): default: 150 - epochs to train.
             steps (int): default: 5000 - batches per epoch to train.
+            road_fraction (float): default: None - fraction of road patches per training batch, patches are drawn
+                uniformly if None.
         """
 
         print("Starting training ...")
@@ -121,7 +123,8 @@ class CnnLrD(BaseModel):
             monitor='val_loss', verbose=0, save_best_only=True,
             save_weights_only=False, mode='auto', period=1)
 
-        self.model.fit_generator(self.train_generator.generate_patch(type="train", train_split=train_split),
+        self.model.fit_generator(self.train_generator.generate_patch(type="train", train_split=train_split,
+                                                                     road_fraction=road_fraction),
                                  steps_per_epoch=steps,
                                  epochs=epochs,
                                  callbacks=[lr_callback, stop_callback, tensorboard_callback,
@@ -129,6 +132,49 @@ class CnnLrD(BaseModel):
                                  validation_data=self.train_generator.generate_patch(type="valid", train_split=train_split),
                                  validation_steps=100)
 
+    def fully_convolutional(self):
+        """Returns an inference-only copy of the model scoring all patches of a padded image in one forward pass.
+
+        The Flatten/Dense head is converted to convolutions with the same weights: the first dense layer becomes a
+        valid convolution whose kernel covers the whole feature map of a window, the following ones 1x1 convolutions.
+        Dropout layers are left out. Given an image padded by the context of its patches, e.g. a 608x608 test image
+        padded to 664x664, the copy returns the (rows, columns, classes) probabilities of its 38x38 patches.
+
+        The convolutions see the image around a window where the windowed model sees zero padding, and the last
+        pooling covers a full cell where the windowed model pools half a cell, so the probabilities approximate those
+        of the windowed model, up to the border of each window.
+
+        Returns:
+            keras.models.Model: the fully convolutional model, taking images of any size.
+        """
+        inputs = keras.layers.Input(shape=(None, None, self.model.input_shape[-1]))
+        outputs = inputs
+        window_features = None
+        for layer in self.model.layers:
+            if isinstance(layer, keras.layers.Dropout):
+                continue
+            if isinstance(layer, keras.layers.Flatten):
+                window_features = layer.input_shape[1:]
+                continue
+
+            config = layer.get_config()
+            config.pop("batch_input_shape", None)
+            weights = layer.get_weights()
+            if isinstance(layer, keras.layers.Dense):
+                # Flatten orders the (rows, columns, channels) feature map of a window row-major
+                kernel_size = window_features[:2] if window_features else (1, 1)
+                weights[0] = weights[0].reshape(kernel_size + (-1, config["units"]))
+                converted = keras.layers.Convolution2D(filters=config["units"], kernel_size=kernel_size,
+                                                       padding="valid", activation=config["activation"],
+                                                       use_bias=config["use_bias"])
+                window_features = None
+            else:
+                converted = layer.__class__.from_config(config)
+
+            outputs = converted(outputs)
+            converted.set_weights(weights)
+        return keras.models.Model(inputs=inputs, outputs=outputs)
+
     def save(self, path):
         """Save the model of the trained model.
 
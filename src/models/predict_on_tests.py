@@ -1,114 +1,197 @@
 #!/usr/bin/env python3
 
-import csv
 import numpy as np
 import os
 
+from utils.dihedral import DIHEDRAL_COUNT, average_views, dihedral, dihedral_views, inverse_dihedral
+from utils.prediction_store import PredictionStoreWriter, road_probabilities
+from utils.storage import to_model
+from utils.submission import SubmissionWriter, merge_submissions
+
 file_path = os.path.dirname(os.path.abspath(__file__))
 
 os.environ["MKL_THREADING_LAYER"] = "GNU"
 
 
-class Prediction_model():
-    def __init__(self, test_generator_class, restored_model):
-
-        self.test_generator_class = test_generator_class
-        self.prediction_model = restored_model
+class PatchInferenceEngine(object):
+    """Runs a patch classifier over the patches of many images in fixed-size batches.
 
-    def prediction_given_model(self):
-
-        test_generator = self.test_generator_class.generate_test_patches()
-        model = self.prediction_model
-
-        predictions = []
-        for img_patches in test_generator:
+    Patches are packed into batches independently of the image they come from, so the batch size is not tied to the
+    number of patches per image, and the predictions are scattered back to one grid per image.
+    """
 
-            prediction = np.zeros((0, 2))
-            for i in range(4):
-                img_predictions = model.predict_on_batch(img_patches[i * 361:(i + 1) * 361])
-                prediction = np.concatenate((prediction, img_predictions))
+    def __init__(self, model, batch_size=512, tta=False):
+        """Initialise the engine.
 
-            predictions.append(prediction)
-
-            # print("First 10 predictions are ",img_predictions[0:10])
-            print("Done with prediction on the image")
-
-        return predictions
-
-    def save_predictions_to_csv(self, predictions, submission_file):
-        """Requires :
-            predictions: 2-d array -> patches for each image
+        Args:
+            model: the restored keras model, mapping windows to class probabilities.
+            batch_size (int): number of patches per call to `predict_on_batch`.
+            tta (bool): average the class probabilities of the 8 dihedral transforms of each window, predicted in the
+                same call to `predict_on_batch` as the window.
         """
-        dimensions = list(self.test_generator_class.data_set[0].shape)
-        w_image = dimensions[0] - self.test_generator_class.context_padding * 2
-        h_image = dimensions[1] - self.test_generator_class.context_padding * 2
-        patch_size = self.test_generator_class.patch_size
-        images_ids = self.test_generator_class.images_ids
-
-        writer = csv.writer(open(submission_file, 'w'), delimiter=",")
-        writer.writerow(["Id", "Prediction"])
-
-        id_idx = 0
-        for prediction_batch in predictions:
-            id_image = images_ids[id_idx]
-            id_length = len(id_image)
-            # Padding with zeros the ids
-            if id_length < 3:
-                zero_padding = 3 - id_length
-                id_image = "0" * zero_padding + str(id_image)
-
-            idx_row = 0
-            idx_column = 0
-            for prediction_probabilities in prediction_batch:
-                prediction = list(prediction_probabilities).index(max(list(prediction_probabilities)))
-                full_row = [str(id_image) + "_" + str(idx_column) + "_" + str(idx_row), str(prediction)]
-                writer.writerow(full_row)
-
-                if idx_row + patch_size < w_image:
-                    idx_row = idx_row + patch_size
-                else:
-                    idx_row = 0
-                    idx_column = idx_column + patch_size
-            id_idx = id_idx + 1
+        self.model = model
+        self.batch_size = batch_size
+        self.tta = tta
 
-        print("Submission csv file written to disk successfully!")
+    def predict_grids(self, images_windows):
+        """Predicts the patches of a sequence of images.
 
+        Args:
+            images_windows (iterable): per image, the windows of its patches as returned by
+                `PatchTestImageGenerator.get_test_patches_from_image` (not flattened), in a storage dtype.
 
-"""def look_matching_pred(csv, id):
-    for row_csv2 in reader_csv2:
-        print("cy")
-        if str(row_csv2[0]) == str(row_csv1[0]):
-            new_submission_entries.append(row_csv2[1])"""
+        Yields:
+            np.ndarray: per image and in input order, the class probabilities of shape
+            (patches_over_width, patches_over_height, classes), i.e. indexed by the row and the column of the patch.
+        """
+        batch = None
+        filled = 0
+        # (image slot, first patch, patch count, offset in the batch) for each run of patches in the batch
+        pending = []
+        # per image: [flat predictions, patches over height, patches over width, patches left to predict]
+        images = []
+
+        for windows in images_windows:
+            patches_over_height, patches_over_width = windows.shape[0:2]
+            image = [None, patches_over_height, patches_over_width, patches_over_height * patches_over_width]
+            images.append(image)
+
+            if batch is None:
+                batch = np.empty((self.batch_size,) + windows.shape[2:], dtype=np.float32)
+
+            for h in range(patches_over_height):
+                w = 0
+                while w < patches_over_width:
+                    count = min(patches_over_width - w, self.batch_size - filled)
+                    to_model(windows[h, w:w + count], out=batch[filled:filled + count])
+                    pending.append((image, h * patches_over_width + w, count, filled))
+                    filled += count
+                    w += count
+
+                    if filled == self.batch_size:
+                        self._run_batch(batch, filled, pending)
+                        filled = 0
+                        pending = []
+                        while images and images[0][3] == 0:
+                            yield self._to_grid(images.pop(0))
+
+        if filled > 0:
+            self._run_batch(batch, filled, pending)
+        while images:
+            yield self._to_grid(images.pop(0))
+
+    def _run_batch(self, batch, filled, pending):
+        if self.tta:
+            predictions = average_views(self.model.predict_on_batch(dihedral_views(batch[:filled])), axes=None)
+        else:
+            predictions = self.model.predict_on_batch(batch[:filled])
+        for image, start, count, offset in pending:
+            if image[0] is None:
+                image[0] = np.empty((image[1] * image[2], predictions.shape[-1]), dtype=predictions.dtype)
+            image[0][start:start + count] = predictions[offset:offset + count]
+            image[3] -= count
+
+    @staticmethod
+    def _to_grid(image):
+        flat, patches_over_height, patches_over_width, _ = image
+        return flat.reshape((patches_over_height, patches_over_width, -1)).swapaxes(0, 1)
+
+
+class FullImageInferenceEngine(object):
+    """Runs a fully convolutional patch classifier, see `models.cnn_lr_d.CnnLrD.fully_convolutional`, over whole
+    images: each padded image is scored in one forward pass instead of one window per patch."""
+
+    def __init__(self, model, tta=False):
+        """Initialise the engine.
+
+        Args:
+            model: the fully convolutional keras model, mapping padded images to grids of class probabilities.
+            tta (bool): average the grids of the 8 dihedral transforms of each image. The transforms of a square image
+                are predicted in one call to `predict_on_batch`.
+        """
+        self.model = model
+        self.tta = tta
 
+    def predict_grids(self, images):
+        """Predicts the patches of a sequence of images.
 
-def hashmap_given_csv(reader_csv1):
-    ids = []
-    for entry in reader_csv1:
-        ids.append(entry)
+        Args:
+            images (iterable): images padded by the context of their patches, e.g. as yielded by
+                `PatchTestImageGenerator.images`, in a storage dtype.
 
+        Yields:
+            np.ndarray: per image and in input order, the class probabilities of shape (rows, columns, classes).
+        """
+        for image in images:
+            batch = to_model(image[np.newaxis])
+            if not self.tta:
+                yield self.model.predict_on_batch(batch)[0]
+            elif image.shape[0] == image.shape[1]:
+                yield average_views(self.model.predict_on_batch(dihedral_views(batch)))[0]
+            else:
+                # the transforms of a rectangular image differ in shape, so they are predicted one by one
+                yield np.mean([inverse_dihedral(self.model.predict_on_batch(dihedral(batch, k)), k)[0]
+                               for k in range(DIHEDRAL_COUNT)], axis=0)
 
-def merge_predictions(csv1_path, csv2_path, submission_file):
-    # Naive way implementation, can be done in several ways : hash map, sorting ids..
-    reader_csv1 = csv.reader(open(csv1_path, 'r'))  # , delimiter=",")
-    reader_csv2 = csv.reader(open(csv2_path, 'r'))  # , delimiter=",")
 
-    hashmap_csv1 = dict(list(reader_csv1))
-    hashmap_csv2 = dict(list(reader_csv2))
+class Prediction_model():
+    def __init__(self, test_generator_class, restored_model, batch_size=512, tta=False, fully_convolutional=False):
+        """Requires :
+            restored_model: the patch classifier, or its fully convolutional copy if fully_convolutional is set, see
+                `FullImageInferenceEngine`
+            batch_size: patches per model call, unused by the fully convolutional copy which takes one image per call
+        """
+        self.test_generator_class = test_generator_class
+        self.prediction_model = restored_model
+        self.fully_convolutional = fully_convolutional
+        if fully_convolutional:
+            self.engine = FullImageInferenceEngine(restored_model, tta=tta)
+        else:
+            self.engine = PatchInferenceEngine(restored_model, batch_size=batch_size, tta=tta)
 
-    new_submission_entries = []
+    def prediction_given_model(self):
+        """Returns the class probabilities of all test images, one (rows, columns, classes) grid per image."""
+        if self.fully_convolutional:
+            test_generator = self.test_generator_class.images()
+        else:
+            test_generator = self.test_generator_class.generate_test_patches()
 
-    # Copy csv1 as new submission to later integrate with csv2
-    new_submission_csv = dict(list(reader_csv1))
+        predictions = []
+        for prediction in self.engine.predict_grids(test_generator):
+            predictions.append(prediction)
+            print("Done with prediction on image {}/{}".format(len(predictions),
+                                                                 len(self.test_generator_class.images_ids)))
 
-    reader_csv1 = list(hashmap_csv1)[1:len(list(hashmap_csv1))]
+        return predictions
 
-    for entry in reader_csv1:
-        if not hashmap_csv1[entry] == '1':
-            hashmap_csv1[entry] = hashmap_csv2[entry]
+    def save_predictions_to_csv(self, predictions, submission_file, store_directory=None, threshold=0.5,
+                                store_options=None):
+        """Requires :
+            predictions: per image, a (rows, columns, classes) grid of patch probabilities
+            submission_file: the file to write, gzip compressed if it ends with `.gz`
+            store_directory: if given, the probabilities are also kept in a prediction store in this directory, see
+                `utils.prediction_store`
+            threshold: patches above this road probability are labelled road
+            store_options: options recorded with the stored probabilities, see `utils.prediction_store`
+        """
+        store = PredictionStoreWriter(store_directory, store_options) if store_directory else None
+        try:
+            with SubmissionWriter(submission_file, self.test_generator_class.patch_size, threshold) as writer:
+                for id_image, prediction_grid in zip(self.test_generator_class.images_ids, predictions):
+                    probabilities = road_probabilities(prediction_grid)
+                    if store:
+                        probabilities = store.write(id_image, probabilities)
+                    writer.write(id_image, probabilities)
+        except BaseException:
+            if store:
+                store.abort()
+            raise
+        if store:
+            store.close()
 
-    new_sub = list(hashmap_csv1)
+        print("Submission csv file written to disk successfully!")
 
-    writer = csv.writer(open(submission_file, 'w'), delimiter=",")
 
-    for key, value in hashmap_csv1.items():
-        writer.writerow([str(key), str(value)])
+def merge_predictions(csv1_path, csv2_path, submission_file):
+    """Labels a patch road if either submission does, see `utils.submission.merge_submissions` for other rules."""
+    merge_submissions([csv1_path, csv2_path], submission_file, rule="or")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PredictionPipeline(object):
+    """Prediction split in a decode, an inference and a write stage running concurrently.
+
+    Items are decoded by a thread pool, predicted in batches on the calling thread and written by a writer thread. The
+    stages are connected by bounded queues, so at most `queue_size` decoded items and results are held in memory, and
+    items are written in input order.
+    """
+
+    def __init__(self, decode, predict, write, decode_workers=4, batch_size=4, queue_size=8):
+        """Initialise the pipeline.
+
+        Args:
+            decode (callable): maps an item, e.g. a file name, to the input of `predict`.
+            predict (callable): maps a list of decoded items to the list of their results.
+            write (callable): called with each item and its result.
+            decode_workers (int): number of decoding threads.
+            batch_size (int): number of items per call to `predict`.
+            queue_size (int): capacity of the queues between the stages.
+        """
+        self.decode = decode
+        self.predict = predict
+        self.write = write
+        self.decode_workers = decode_workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+
+    def run(self, items):
+        """Runs all items through the pipeline.
+
+        Returns:
+            dict: the number of items, the wall time and the time spent in each stage, in seconds. The decode time is
+            summed over the decoding threads.
+        """
+        timings = {"items": 0, "decode": 0., "predict": 0., "write": 0.}
+        lock = threading.Lock()
+        stop = threading.Event()
+        decoded = queue.Queue(maxsize=self.queue_size)
+        results = queue.Queue(maxsize=self.queue_size)
+        write_errors = []
+
+        def timed(stage, function, *args):
+            start = time.time()
+            result = function(*args)
+            with lock:
+                timings[stage] += time.time() - start
+            return result
+
+        def put(stage_queue, entry):
+            while not stop.is_set():
+                try:
+                    stage_queue.put(entry, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(stage_queue):
+            while not stop.is_set():
+                try:
+                    return stage_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            return None
+
+        def feed(executor):
+            try:
+                for item in items:
+                    if not put(decoded, (item, executor.submit(timed, "decode", self.decode, item))):
+                        return
+            except Exception as e:
+                put(decoded, e)
+                return
+            put(decoded, None)
+
+        def write():
+            while True:
+                entry = get(results)
+                if entry is None:
+                    return
+                try:
+                    timed("write", self.write, *entry)
+                except Exception as e:
+                    write_errors.append(e)
+                    stop.set()
+                    return
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.decode_workers) as executor:
+            feeder = threading.Thread(target=feed, args=(executor,), daemon=True)
+            writer = threading.Thread(target=write, daemon=True)
+            feeder.start()
+            writer.start()
+            try:
+                done = False
+                while not done and not stop.is_set():
+                    batch_items = []
+                    batch_inputs = []
+                    while len(batch_items) < self.batch_size:
+                        entry = get(decoded)
+                        if entry is None:
+                            done = True
+                            break
+                        if isinstance(entry, Exception):
+                            raise entry
+                        batch_items.append(entry[0])
+                        batch_inputs.append(entry[1].result())
+                    if batch_items:
+                        for entry in zip(batch_items, timed("predict", self.predict, batch_inputs)):
+                            put(results, entry)
+                        timings["items"] += len(batch_items)
+                put(results, None)
+                writer.join()
+            finally:
+                stop.set()
+
+        if write_errors:
+            raise write_errors[0]
+        timings["wall"] = time.time() - start
+        return timings
+
+    @staticmethod
+    def report(timings):
+        """Prints the throughput and the per-stage timing of a run."""
+        print("[INFO] Predicted {} images in {:.1f}s ({:.2f} images/s): decode {:.1f}s, inference {:.1f}s, "
+              "write {:.1f}s".format(timings["items"], timings["wall"], timings["items"] / max(timings["wall"], 1e-9),
+                                     timings["decode"], timings["predict"], timings["write"]))
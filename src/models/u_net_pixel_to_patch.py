@@ -2,6 +2,7 @@ import os
 import re
 
 import keras
+import numpy as np
 from keras import Input, Model
 from keras import backend as K
 from keras.callbacks import ModelCheckpoint, EarlyStopping, ReduceLROnPlateau, TensorBoard
@@ -12,7 +13,12 @@ from keras.optimizers import Adam, RMSprop
 from scipy import ndimage
 
 from models.base_model import BaseModel
+from models.prediction_pipeline import PredictionPipeline
 from utils.commons import properties
+from utils.dihedral import average_views, dihedral_views
+from utils.prediction_store import PredictionStoreWriter
+from utils.storage import to_model
+from utils.submission import SubmissionWriter
 
 file_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -27,6 +33,8 @@ class UNet(BaseModel):
 
         self.validation_steps = 50
         self.batch_size = 4
+        self.input_size = 608
+        self.patch_size = 16
         if type is "normal":
             self.model = UNet.get_unet_downsampling(activation="relu", regularizer=1e-6, dropout_rate=0.0)
         else:
@@ -61,30 +69,126 @@ class UNet(BaseModel):
                                  validation_data=self.train_generator.next_batch("valid", batch_size=self.batch_size),
                                  validation_steps=self.validation_steps)
 
-    def predict(self, path_images, submission_path_filename):
-        images_files = sorted(os.listdir(os.path.join(path_images, "data")))
-        with open(submission_path_filename, 'w') as f:
-            f.write('Id,Prediction\n')
-            for idx, name in enumerate(images_files):
-                image = ndimage.imread(os.path.join(path_images, "data", name)).reshape((1, 608, 608, 3)) / 255.0
-                # image = test_images[idx].reshape((1, 608, 608, 3)) / 255.
-                predicted_mask = self.model.predict(image)
-                predicted_mask = predicted_mask.reshape((38, 38))
-                submission_string = self.mask_to_submission_strings(name, predicted_mask)
-                f.writelines('{}\n'.format(s) for s in submission_string)
+    def predict(self, path_images, submission_path_filename, overlap=64, batch_size=None, decode_workers=4,
+                store_directory=None, threshold=0.5, images_files=None, tta=False, store_options=None):
+        """Predicts all PNG images of a directory and writes their submission rows.
 
-    def load(self, filename):
-        self.model.load_weights(filename)
+        Decoding, inference and writing run as a pipeline, see `PredictionPipeline`.
+
+        Args:
+            path_images (path): directory of the images.
+            submission_path_filename (path): the submission file to write, gzip compressed if it ends with `.gz`.
+            overlap (int): overlap of the tiles of large images, see `predict_grids`.
+            batch_size (int): images per inference batch, defaults to the training batch size.
+            decode_workers (int): number of threads decoding images.
+            store_directory (path): if given, the probabilities are also kept in a prediction store in this directory,
+                see `utils.prediction_store`.
+            threshold (float): patches above this road probability are labelled road.
+            images_files (list): names of the images in `path_images` to predict, all PNG images by default.
+            tta (bool): average the predictions of the 8 dihedral transforms of each tile, see `predict_grids`.
+            store_options (dict): options recorded with the stored probabilities, see `utils.prediction_store`.
+        """
+        if images_files is None:
+            images_files = sorted(name for name in os.listdir(path_images) if name.endswith(".png"))
+        batch_size = batch_size or self.batch_size
+
+        def decode(name):
+            return to_model(ndimage.imread(os.path.join(path_images, name))[..., :3])
+
+        def predict(images):
+            return self.predict_grids(images, overlap=overlap, batch_size=batch_size, tta=tta)
+
+        store = PredictionStoreWriter(store_directory, store_options) if store_directory else None
+        try:
+            with SubmissionWriter(submission_path_filename, self.patch_size, threshold) as writer:
+
+                def write(name, predicted_mask):
+                    image_id = re.search(r"\d+", name).group(0)
+                    if store:
+                        predicted_mask = store.write(image_id, predicted_mask)
+                    writer.write(image_id, predicted_mask)
+
+                pipeline = PredictionPipeline(decode, predict, write, decode_workers=decode_workers,
+                                              batch_size=batch_size)
+                PredictionPipeline.report(pipeline.run(images_files))
+        except BaseException:
+            if store:
+                store.abort()
+            raise
+        if store:
+            store.close()
+
+    def predict_grids(self, images, overlap=64, batch_size=None, tta=False):
+        """Predicts the patch probabilities of images of any size.
+
+        Each image is split into overlapping tiles of the input size of the model, the tiles of all images are run
+        through the model in batches and the tile predictions are blended back into one grid per image, weighting each
+        tile down linearly towards its borders within the overlap. Images smaller than a tile or not a multiple of the
+        patch size are reflect-padded. With test-time augmentation, the 8 dihedral transforms of the tiles of a batch
+        are predicted in the same model call and their predictions transformed back and averaged.
+
+        Args:
+            images (list): float32 (height, width, 3) images with values in [0, 1].
+            overlap (int): overlap of neighbouring tiles in pixels, a multiple of the patch size.
+            batch_size (int): tiles per model call, defaults to the training batch size.
+            tta (bool): use test-time augmentation.
+
+        Returns:
+            list: per image, the (ceil(height / patch_size), ceil(width / patch_size)) grid of road probabilities.
+        """
+        tile_size = self.input_size
+        patch_size = self.patch_size
+        tile_cells = tile_size // patch_size
+        overlap_cells = overlap // patch_size
+        if overlap % patch_size != 0 or not 0 <= overlap_cells < tile_cells:
+            raise ValueError("Tile overlap {} is not a multiple of {} smaller than {}".format(overlap, patch_size,
+                                                                                             tile_size))
+        batch_size = batch_size or self.batch_size
+
+        ramp = np.minimum(np.arange(1, tile_cells + 1), np.arange(tile_cells, 0, -1)) / (overlap_cells + 1.)
+        ramp = np.minimum(ramp, 1.)
+        weights = np.outer(ramp, ramp)
+
+        padded_images = []
+        grids = []
+        totals = []
+        tiles = []
+        for idx, image in enumerate(images):
+            height = max(tile_size, -(-image.shape[0] // patch_size) * patch_size)
+            width = max(tile_size, -(-image.shape[1] // patch_size) * patch_size)
+            padded = np.pad(image, ((0, height - image.shape[0]), (0, width - image.shape[1]), (0, 0)), mode="reflect")
+            padded_images.append(padded)
+            grids.append(np.zeros((height // patch_size, width // patch_size)))
+            totals.append(np.zeros((height // patch_size, width // patch_size)))
+            tiles += [(idx, row, col) for row in self.tile_starts(height, tile_size, tile_size - overlap)
+                      for col in self.tile_starts(width, tile_size, tile_size - overlap)]
+
+        batch = np.empty((min(batch_size, len(tiles)), tile_size, tile_size, 3), dtype=np.float32)
+        for start in range(0, len(tiles), batch_size):
+            batch_tiles = tiles[start:start + batch_size]
+            for i, (idx, row, col) in enumerate(batch_tiles):
+                batch[i] = padded_images[idx][row:row + tile_size, col:col + tile_size]
+            if tta:
+                predictions = self.model.predict_on_batch(dihedral_views(batch[:len(batch_tiles)]))
+                predictions = average_views(predictions.reshape((-1, tile_cells, tile_cells)))
+            else:
+                predictions = self.model.predict_on_batch(batch[:len(batch_tiles)])
+            for (idx, row, col), prediction in zip(batch_tiles, predictions):
+                cells = (slice(row // patch_size, row // patch_size + tile_cells),
+                         slice(col // patch_size, col // patch_size + tile_cells))
+                grids[idx][cells] += weights * prediction.reshape((tile_cells, tile_cells))
+                totals[idx][cells] += weights
+
+        return [(grid / total)[:-(-image.shape[0] // patch_size), :-(-image.shape[1] // patch_size)]
+                for grid, total, image in zip(grids, totals, images)]
 
     @staticmethod
-    def mask_to_submission_strings(image_filename, predicted_mask):
-        """Reads a single image and outputs the strings that should go into the submission file"""
-        img_number = int(re.search(r"\d+", image_filename).group(0))
-        for j in range(38):
-            for i in range(38):
-                patch = predicted_mask[i, j]
-                label = int(patch > 0.5)
-                yield ("{:03d}_{}_{},{}".format(img_number, j * 16, i * 16, label))
+    def tile_starts(length, tile_size, stride):
+        """Returns the offsets of tiles covering `length` with the given stride, the last tile ending at `length`."""
+        return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+    def load(self, filename):
+        self.model.load_weights(filename)
 
     @staticmethod
     def get_unet_layer_down(size, depth, inputs, activation="relu", dropout_rate=0.0):
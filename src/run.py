@@ -2,14 +2,14 @@
 
 import argparse
 import datetime
+import re
 import time
 
-from generators.ImageToPatchGenerator import ImageToPatchGenerator
-from generators.PatchTestImageGenerator import PatchTestImageGenerator
-from generators.PatchTrainImageGenerator import PatchTrainImageGenerator
-from models import cnn_lr_d, u_net_pixel_to_patch
-from models import predict_on_tests
-from visualization import *
+from utils.commons import *
+from utils.submission import MERGE_RULES
+
+# Each action imports the modules it needs, so actions not running a model start without importing keras and
+# tensorflow, and only visualizing imports matplotlib.pyplot. `python src/benchmark.py startup` checks this.
 
 
 def _setup_argparser():
@@ -32,6 +32,45 @@ def _setup_argparser():
     parser.add_argument("-tr", "--train_resume",
                         help="continue training the given CNN",
                         action="store_true")
+    parser.add_argument("-w", "--workers",
+                        help="threads preparing training batches in the background, or decoding images when "
+                             "predicting (u_net)",
+                        action="store",
+                        default=4,
+                        type=int)
+    parser.add_argument("--seed",
+                        help="seed of the training data generators",
+                        action="store",
+                        default=None,
+                        type=int)
+    parser.add_argument("--dtype",
+                        help="storage dtype of the images held in memory by the generators",
+                        choices=["uint8", "float32", "float64"],
+                        default="uint8",
+                        type=str)
+    parser.add_argument("--no_cache",
+                        help="decode the training images instead of memory-mapping them from the dataset cache",
+                        action="store_true")
+    parser.add_argument("--processes",
+                        help="processes decoding the training images when preparing the dataset cache or loading "
+                             "them without it, defaults to the number of CPUs",
+                        action="store",
+                        default=None,
+                        type=int)
+    parser.add_argument("--sharded",
+                        help="directory of sharded training datasets, read at random instead of held in memory. "
+                             "With --prepare, the sharded datasets are written there",
+                        action="store",
+                        default=None,
+                        type=str)
+    parser.add_argument("--pool_size",
+                        help="augmented training images held in memory per split (u_net), defaults to all images",
+                        action="store",
+                        default=None,
+                        type=int)
+    parser.add_argument("--prepare",
+                        help="prepare the dataset cache of the training sets",
+                        action="store_true")
     parser.add_argument("-d", "--data",
                         help="path to the data to use (prediction)",
                         action="store",
@@ -40,9 +79,63 @@ def _setup_argparser():
     parser.add_argument("-p", "--predict",
                         help="predict on a test set given the CNN",
                         action="store_true")
+    parser.add_argument("-s", "--stream",
+                        help="load the test images lazily while predicting with cnn_lr_d",
+                        action="store_true")
+    parser.add_argument("-bs", "--batch_size",
+                        help="patches (cnn_lr_d, default 512) or images (u_net, default 4) per model call when "
+                             "predicting",
+                        action="store",
+                        default=None,
+                        type=int)
+    parser.add_argument("--overlap",
+                        help="overlap in pixels of the tiles of large images when predicting with u_net",
+                        action="store",
+                        default=64,
+                        type=int)
+    parser.add_argument("--tta",
+                        help="average the predictions of the 8 rotations and flips of the inputs when predicting",
+                        action="store_true")
+    parser.add_argument("--fcn",
+                        help="score each test image in one pass of the fully convolutional copy of cnn_lr_d instead "
+                             "of one window per patch, approximating its predictions at the window borders",
+                        action="store_true")
+    parser.add_argument("--threshold",
+                        help="road probability above which a patch is labelled road, defaults to 0.5. When "
+                             "predicting, the stored predictions of the latest run are labelled again if they exist",
+                        action="store",
+                        default=None,
+                        type=float)
+    parser.add_argument("--merge",
+                        help="merge the given submissions, or the stored predictions of the given runs, into one",
+                        action="store",
+                        nargs="+",
+                        metavar="SUBMISSION")
+    parser.add_argument("--merge_rule",
+                        help="how merged submissions are combined per patch, average only for run directories",
+                        choices=list(MERGE_RULES),
+                        default="or",
+                        type=str)
+    parser.add_argument("--merge_weights",
+                        help="weight of each merged submission (majority and average rules)",
+                        action="store",
+                        nargs="+",
+                        type=float)
+    parser.add_argument("-o", "--output",
+                        help="file of the merged submission, gzip compressed if it ends with .gz",
+                        action="store",
+                        type=str)
+    parser.add_argument("-e", "--evaluate",
+                        help="score the latest u_net run on the validation split for a range of thresholds",
+                        action="store_true")
     parser.add_argument("-vis", "--visualize",
                         help="visualize prediction of an image given its id",
                         action="store")
+    parser.add_argument("--diff",
+                        help="with -vis, show the patches on which the given submission differs from the latest one",
+                        action="store",
+                        metavar="SUBMISSION",
+                        type=str)
 
     args, unknown = parser.parse_known_args()
 
@@ -118,57 +211,87 @@ if __name__ == "__main__":
             os.makedirs(properties["OUTPUT_DIR"])
         except OSError:
             pass
-    elif args.train_resume or args.predict:
+    elif args.train_resume or args.predict or args.evaluate:
         properties["OUTPUT_DIR"] = get_latest_model()
         properties["LOG_DIR"] = os.path.join(properties["OUTPUT_DIR"], "logs")
     else:
         properties["OUTPUT_DIR"] = os.path.normpath("..")
 
     properties["LOG_DIR"] = os.path.join(properties["OUTPUT_DIR"], "logs")
+    cache_dir = None if args.no_cache else properties["CACHE_DIR"]
+    sharded_608 = os.path.join(args.sharded, "608") if args.sharded else None
+    sharded_400 = os.path.join(args.sharded, "400") if args.sharded else None
+    threshold = 0.5 if args.threshold is None else args.threshold
 
     if args.train:
+        from generators.ImageToPatchGenerator import ImageToPatchGenerator
+        from generators.PatchTrainImageGenerator import PatchTrainImageGenerator
+        from models import cnn_lr_d, u_net_pixel_to_patch
+
         if args.model == "cnn_lr_d":
             train_generator = PatchTrainImageGenerator(os.path.join(properties["TRAIN_DIR_400"], "data"),
-                                                       os.path.join(properties["TRAIN_DIR_400"], "verify"))
+                                                       os.path.join(properties["TRAIN_DIR_400"], "verify"),
+                                                       dtype=args.dtype, cache_dir=cache_dir,
+                                                       processes=args.processes, dataset_dir=sharded_400,
+                                                       seed=args.seed)
             model = cnn_lr_d.CnnLrD(train_generator)
             model.train()
         elif args.model == "u_net":
             generator = ImageToPatchGenerator(os.path.join(properties["TRAIN_DIR_608"]),
-                                              os.path.join(properties["TEST_DIR"]), 500, 200, True)
+                                              os.path.join(properties["TEST_DIR"]), 500, 200, True,
+                                              workers=args.workers, seed=args.seed, dtype=args.dtype,
+                                              cache_dir=cache_dir, processes=args.processes,
+                                              dataset_dir=sharded_608, pool_size=args.pool_size)
             model = u_net_pixel_to_patch.UNet(generator, None)
             model.train()
         elif args.model == "u_net_dropout":
             generator = ImageToPatchGenerator(os.path.join(properties["TRAIN_DIR_608"]),
-                                              os.path.join(properties["TEST_DIR"]), 500, 200, True)
+                                              os.path.join(properties["TEST_DIR"]), 500, 200, True,
+                                              workers=args.workers, seed=args.seed, dtype=args.dtype,
+                                              cache_dir=cache_dir, processes=args.processes,
+                                              dataset_dir=sharded_608, pool_size=args.pool_size)
             model = u_net_pixel_to_patch.UNet(generator, None, type="dropout")
             model.train()
 
     elif args.train_resume:
+        from generators.ImageToPatchGenerator import ImageToPatchGenerator
+        from generators.PatchTrainImageGenerator import PatchTrainImageGenerator
+        from models import cnn_lr_d, u_net_pixel_to_patch
 
         model = None
         if args.model == "cnn_lr_d":
             train_generator = PatchTrainImageGenerator(os.path.join(properties["TRAIN_DIR_400"], "data"),
-                                                       os.path.join(properties["TRAIN_DIR_400"], "verify"))
+                                                       os.path.join(properties["TRAIN_DIR_400"], "verify"),
+                                                       dtype=args.dtype, cache_dir=cache_dir,
+                                                       processes=args.processes, dataset_dir=sharded_400,
+                                                       seed=args.seed)
             model = cnn_lr_d.CnnLrD(train_generator,
                                     path=os.path.join(properties["OUTPUT_DIR"], "weights.h5"))
             model.train()
 
         elif args.model == "u_net":
             generator = ImageToPatchGenerator(os.path.join(properties["TRAIN_DIR_608"]),
-                                              os.path.join(properties["TEST_DIR"]), 500, 200, True)
+                                              os.path.join(properties["TEST_DIR"]), 500, 200, True,
+                                              workers=args.workers, seed=args.seed, dtype=args.dtype,
+                                              cache_dir=cache_dir, processes=args.processes,
+                                              dataset_dir=sharded_608, pool_size=args.pool_size)
 
             print("[INFO] Path ", properties["OUTPUT_DIR"])
             model = u_net_pixel_to_patch.UNet(generator, path=os.path.join(properties["OUTPUT_DIR"], "weights.h5"))
             model.train()
         elif args.model == "u_net_dropout":
             generator = ImageToPatchGenerator(os.path.join(properties["TRAIN_DIR_608"]),
-                                              os.path.join(properties["TEST_DIR"]), 500, 200, True)
+                                              os.path.join(properties["TEST_DIR"]), 500, 200, True,
+                                              workers=args.workers, seed=args.seed, dtype=args.dtype,
+                                              cache_dir=cache_dir, processes=args.processes,
+                                              dataset_dir=sharded_608, pool_size=args.pool_size)
 
             print("[INFO] Path ", properties["OUTPUT_DIR"])
             model = u_net_pixel_to_patch.UNet(generator, path=os.path.join(properties["OUTPUT_DIR"], "weights.h5"), type="dropout")
             model.train()
 
     elif args.predict:
+        from utils.prediction_store import PredictionStore
 
         """
            Path to data to predict on,
@@ -180,42 +303,155 @@ if __name__ == "__main__":
         """Submission file"""
         submission_path_filename = get_submission_filename()
 
-        print("[INFO] Loading the last checkpoint of the model ", args.model, " from: ", path_model_to_restore)
-
+        # the stored predictions are only relabelled if they were made on the same images with the same weights
+        prediction_options = {"data": os.path.abspath(data_path), "tta": args.tta,
+                              "weights_mtime": os.path.getmtime(path_model_to_restore)}
         if args.model == "cnn_lr_d":
+            prediction_options.update(fcn=args.fcn, dtype=args.dtype)
+        else:
+            prediction_options.update(overlap=args.overlap)
+
+        relabel = args.threshold is not None and PredictionStore.matches(properties["OUTPUT_DIR"], prediction_options)
+        if args.threshold is not None and not relabel and PredictionStore.exists(properties["OUTPUT_DIR"]):
+            print("[INFO] The stored predictions of ", properties["OUTPUT_DIR"], " were made with other images or "
+                  "options, predicting again")
+        if not relabel:
+            print("[INFO] Loading the last checkpoint of the model ", args.model, " from: ", path_model_to_restore)
+
+        if relabel:
+            print("[INFO] Labelling the stored predictions of ", properties["OUTPUT_DIR"], " with threshold ",
+                  args.threshold)
+            PredictionStore(properties["OUTPUT_DIR"]).write_submission(submission_path_filename,
+                                                                       threshold=args.threshold)
+
+        elif args.model == "cnn_lr_d":
+            from generators.PatchTestImageGenerator import PatchTestImageGenerator
+            from models import cnn_lr_d, predict_on_tests
 
             test_generator_class = PatchTestImageGenerator(path_to_images=os.path.join(data_path),
                                                            save_predictions_path=os.path.join(properties["OUTPUT_DIR"],
-                                                                                              "predictions"))
+                                                                                              "predictions"),
+                                                           stream=args.stream, dtype=args.dtype)
 
             model_class = cnn_lr_d.CnnLrD(test_generator_class, path=path_model_to_restore)
-            model = model_class.model
+            model = model_class.fully_convolutional() if args.fcn else model_class.model
 
             print("[INFO] Model has been restored successfully")
             prediction_model = predict_on_tests.Prediction_model(test_generator_class=test_generator_class,
-                                                                 restored_model=model)
+                                                                 restored_model=model,
+                                                                 batch_size=args.batch_size or 512, tta=args.tta,
+                                                                 fully_convolutional=args.fcn)
             predictions = prediction_model.prediction_given_model()
 
             print("[INFO] Writing predictions to: ", submission_path_filename)
-            prediction_model.save_predictions_to_csv(predictions=predictions, submission_file=submission_path_filename)
+            prediction_model.save_predictions_to_csv(predictions=predictions, submission_file=submission_path_filename,
+                                                     store_directory=properties["OUTPUT_DIR"],
+                                                     threshold=threshold, store_options=prediction_options)
 
         elif args.model == "u_net":
-            generator = ImageToPatchGenerator(os.path.join(properties["TRAIN_DIR_608"]),
-                                              os.path.join(properties["TEST_DIR"]), 500, 200, True)
+            from models import u_net_pixel_to_patch
 
             print("[INFO] Path ", properties["OUTPUT_DIR"])
-            model = u_net_pixel_to_patch.UNet(generator, path=os.path.join(properties["OUTPUT_DIR"], "weights.h5"))
-            model.predict(os.path.join(properties["TEST_DIR"]), submission_path_filename)
+            model = u_net_pixel_to_patch.UNet(None, path=os.path.join(properties["OUTPUT_DIR"], "weights.h5"))
+            model.predict(data_path, submission_path_filename, overlap=args.overlap, batch_size=args.batch_size,
+                          decode_workers=args.workers, store_directory=properties["OUTPUT_DIR"], threshold=threshold,
+                          tta=args.tta, store_options=prediction_options)
 
         elif args.model == "u_net_dropout":
-            generator = ImageToPatchGenerator(os.path.join(properties["TRAIN_DIR_608"]),
-                                              os.path.join(properties["TEST_DIR"]), 500, 200, True)
+            from models import u_net_pixel_to_patch
 
             print("[INFO] Path ", properties["OUTPUT_DIR"])
-            model = u_net_pixel_to_patch.UNet(generator, path=os.path.join(properties["OUTPUT_DIR"], "weights.h5"), type="dropout")
-            model.predict(os.path.join(properties["TEST_DIR"]), submission_path_filename)
+            model = u_net_pixel_to_patch.UNet(None, path=os.path.join(properties["OUTPUT_DIR"], "weights.h5"), type="dropout")
+            model.predict(data_path, submission_path_filename, overlap=args.overlap, batch_size=args.batch_size,
+                          decode_workers=args.workers, store_directory=properties["OUTPUT_DIR"], threshold=threshold,
+                          tta=args.tta, store_options=prediction_options)
+
+    elif args.evaluate:
+        from generators.ImageToPatchGenerator import ImageToPatchGenerator, TRAIN_VALID_SPLIT
+        from utils import evaluation
+        from utils.prediction_store import PredictionStore
+
+        if args.model == "cnn_lr_d":
+            # cnn_lr_d validates on windows of the 400x400 set labelled with PatchTrainImageGenerator.threshold, which
+            # is not swept
+            print("[INFO] Evaluation on the validation split is only available for the u_net models")
+            sys.exit(1)
+
+        store_directory = os.path.join(properties["OUTPUT_DIR"], "validation")
+        image_files, mask_files = ImageToPatchGenerator.dataset_files(properties["TRAIN_DIR_608"], "valid",
+                                                                      TRAIN_VALID_SPLIT)
+        images_files = [os.path.basename(image_file) for image_file in image_files]
+        # the stored predictions are predicted again after training resumed in the same run, or for other options
+        validation_options = {"images": images_files, "overlap": args.overlap, "tta": args.tta,
+                              "weights_mtime": os.path.getmtime(os.path.join(properties["OUTPUT_DIR"], "weights.h5"))}
+        if not PredictionStore.matches(store_directory, validation_options):
+            from models import u_net_pixel_to_patch
+
+            os.makedirs(store_directory, exist_ok=True)
+            model = u_net_pixel_to_patch.UNet(None, path=os.path.join(properties["OUTPUT_DIR"], "weights.h5"),
+                                              type="normal" if args.model == "u_net" else "dropout")
+            model.predict(os.path.join(properties["TRAIN_DIR_608"], "data"),
+                          os.path.join(store_directory, "submission_validation.csv"), overlap=args.overlap,
+                          batch_size=args.batch_size, decode_workers=args.workers, store_directory=store_directory,
+                          images_files=images_files, tta=args.tta, store_options=validation_options)
+
+        print("[INFO] Evaluating the predictions stored in ", store_directory)
+        image_ids = [re.search(r"\d+", os.path.basename(image_file)).group(0) for image_file in image_files]
+        f1, accuracy, _ = evaluation.evaluate_store(PredictionStore(store_directory), mask_files, image_ids)
+        evaluation.report(f1, accuracy)
+
+    elif args.merge:
+        from utils.prediction_store import merge_stores
+        from utils.submission import merge_submissions
+
+        merged_file = args.output or os.path.join(os.path.dirname(os.path.abspath(args.merge[0].rstrip("/"))),
+                                                  "submission_merged_{}.csv".format(int(time.time())))
+        if all(os.path.isdir(path) for path in args.merge):
+            merge_stores(args.merge, merged_file, rule=args.merge_rule, weights=args.merge_weights,
+                         threshold=threshold)
+        elif args.merge_rule == "average":
+            print("[INFO] Submissions only hold labels, whose average is their majority. Merge the directories of "
+                  "trained models to average their stored probabilities, or use --merge_rule majority")
+            sys.exit(1)
+        else:
+            merge_submissions(args.merge, merged_file, rule=args.merge_rule, weights=args.merge_weights)
 
     elif args.visualize:
+        from utils.prediction_store import PredictionStore
+        from visualization import visualize, visualize_diff, visualize_probabilities
+
         print("[INFO] Visualizing predictions of the model: ", args.model)
-        visualize(id_img=args.visualize, csv_file=get_latest_submission(), path_to_images=os.path.join(args.data),
-                  patch_size=16)
+        if args.diff:
+            visualize_diff(id_img=args.visualize, csv_file=get_latest_submission(), other_csv_file=args.diff,
+                           path_to_images=os.path.join(args.data), patch_size=16)
+        elif PredictionStore.exists(get_latest_model()):
+            visualize_probabilities(id_img=args.visualize, store_directory=get_latest_model(),
+                                    path_to_images=os.path.join(args.data), patch_size=16, threshold=threshold)
+        else:
+            visualize(id_img=args.visualize, csv_file=get_latest_submission(), path_to_images=os.path.join(args.data),
+                      patch_size=16)
+
+    elif args.prepare:
+        from generators.ImageToPatchGenerator import ImageToPatchGenerator, TRAIN_VALID_SPLIT
+        from generators.PatchTrainImageGenerator import PatchTrainImageGenerator
+        from utils import dataset_cache, sharded_dataset
+
+        # the split and the padding the generators open the datasets with by default
+        for split in ("train", "valid"):
+            image_files, mask_files = ImageToPatchGenerator.dataset_files(properties["TRAIN_DIR_608"], split,
+                                                                          TRAIN_VALID_SPLIT)
+            if not args.sharded:
+                dataset_cache.load_dataset(image_files, mask_files, 0, args.dtype, properties["CACHE_DIR"],
+                                           args.processes)
+            elif not sharded_dataset.ShardedDataset.exists(os.path.join(sharded_608, split)):
+                sharded_dataset.write_sharded_dataset(image_files, mask_files, os.path.join(sharded_608, split), 0,
+                                                      args.dtype, processes=args.processes)
+        image_files, mask_files = PatchTrainImageGenerator.dataset_files(
+            os.path.join(properties["TRAIN_DIR_400"], "data"), os.path.join(properties["TRAIN_DIR_400"], "verify"))
+        padding = PatchTrainImageGenerator.context_padding()
+        if not args.sharded:
+            dataset_cache.load_dataset(image_files, mask_files, padding, args.dtype, properties["CACHE_DIR"],
+                                       args.processes)
+        elif not sharded_dataset.ShardedDataset.exists(sharded_400):
+            sharded_dataset.write_sharded_dataset(image_files, mask_files, sharded_400, padding, args.dtype,
+                                                  processes=args.processes)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+"""Local prediction server keeping a restored model in memory, run from the project root, e.g.:
+
+    python ./src/serve.py -m u_net --port 8000
+
+Requests:
+    POST /predict with a PNG image as body (`Content-Type: image/png`, the image number in the `id` query parameter),
+        or with a JSON body `{"paths": [<png path>, ...]}`. Returns the grids of road probabilities of the images as
+        JSON, or their submission rows with the query parameter `format=csv`.
+    GET /health returns the served model.
+
+    GET /metrics returns the queue depth and batch statistics of the batcher, see `AsyncBatcher.metrics`.
+
+Images of concurrent requests are predicted together, see `models.batching.AsyncBatcher`.
+"""
+
+import argparse
+import io
+import json
+import os
+import re
+import socketserver
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from keras import backend as K
+from scipy import ndimage
+
+from generators.PatchTestImageGenerator import CONTEXT_PADDING, patch_windows
+from models import cnn_lr_d, u_net_pixel_to_patch
+from models.batching import AsyncBatcher
+from models.predict_on_tests import PatchInferenceEngine
+from utils.commons import latest_run, properties
+from utils.dataset_cache import pad_image
+from utils.prediction_store import road_probabilities
+from utils.storage import to_model
+from utils.submission import SubmissionFormatter
+
+
+def load_predictor(model_name, run_directory, overlap=64, batch_size=None, tta=False):
+    """Restores a run of a model.
+
+    Returns:
+        callable: maps a list of uint8 (height, width, 3) images to the list of their grids of road probabilities. It
+        can be called from any thread.
+    """
+    path = os.path.join(run_directory, "weights.h5")
+    if model_name == "cnn_lr_d":
+        engine = PatchInferenceEngine(cnn_lr_d.CnnLrD(None, path=path).model, batch_size=batch_size or 512, tta=tta)
+
+        def predict_images(images):
+            return [road_probabilities(grid) for grid in engine.predict_grids(
+                patch_windows(pad_image(image, CONTEXT_PADDING))[1] for image in images)]
+    else:
+        model = u_net_pixel_to_patch.UNet(None, path=path, type="normal" if model_name == "u_net" else "dropout")
+
+        def predict_images(images):
+            return model.predict_grids([to_model(image) for image in images], overlap=overlap, batch_size=batch_size,
+                                       tta=tta)
+
+    # the tensorflow graph of the model is only the default graph of the thread that restored it
+    graph = K.get_session().graph
+
+    def predict(images):
+        with graph.as_default():
+            return predict_images(images)
+
+    return predict
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """Handles the requests of the server, which holds the `batcher`, the `formatter` and the `model_name`."""
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self.reply(200, "application/json", json.dumps({"model": self.server.model_name, "status": "ok"}))
+        elif path == "/metrics":
+            self.reply(200, "application/json", json.dumps(self.server.batcher.metrics()))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/predict":
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        try:
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                paths = json.loads(body.decode())["paths"]
+                image_ids = [re.search(r"\d+", os.path.basename(path)).group(0) for path in paths]
+                images = [ndimage.imread(path)[..., :3] for path in paths]
+            else:
+                image_ids = [query.get("id", ["0"])[0]]
+                images = [ndimage.imread(io.BytesIO(body))[..., :3]]
+        except Exception as e:
+            self.reply(400, "application/json", json.dumps({"error": "Invalid request: {}".format(e)}))
+            return
+
+        try:
+            grids = [future.result() for future in [self.server.batcher.submit(image) for image in images]]
+        except Exception as e:
+            self.reply(500, "application/json", json.dumps({"error": "Prediction failed: {}".format(e)}))
+            return
+
+        if query.get("format", ["json"])[0] == "csv":
+            self.reply(200, "text/csv", "".join(self.server.formatter.format(image_id, grid)
+                                                for image_id, grid in zip(image_ids, grids)))
+        else:
+            self.reply(200, "application/json", json.dumps({"predictions": [
+                {"id": image_id, "grid": grid.tolist()} for image_id, grid in zip(image_ids, grids)]}))
+
+    def reply(self, status, content_type, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(predict, model_name, host="127.0.0.1", port=8000, max_batch_size=4, max_latency=0.01, threshold=0.5):
+    """Serves the predictions of a model until interrupted."""
+    server = ThreadingHTTPServer((host, port), PredictionRequestHandler)
+    server.model_name = model_name
+    server.batcher = AsyncBatcher(predict, max_batch_size=max_batch_size, max_latency=max_latency)
+    server.batcher.start()
+    server.formatter = SubmissionFormatter(threshold=threshold)
+    print("[INFO] Serving {} on http://{}:{}".format(model_name, host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _setup_argparser():
+    """Sets up the argument parser and returns the arguments.
+
+    Returns:
+        argparse.Namespace: The command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Local prediction server keeping a model in memory.")
+    parser.add_argument("-m", "--model", action="store",
+                        choices=["cnn_lr_d", "u_net", "u_net_dropout"],
+                        default="u_net_dropout",
+                        type=str,
+                        help="the CNN model to serve, its latest run is restored")
+    parser.add_argument("--host",
+                        help="address to listen on",
+                        action="store",
+                        default="127.0.0.1",
+                        type=str)
+    parser.add_argument("--port",
+                        help="port to listen on",
+                        action="store",
+                        default=8000,
+                        type=int)
+    parser.add_argument("--max_batch_size",
+                        help="maximum number of images predicted together",
+                        action="store",
+                        default=4,
+                        type=int)
+    parser.add_argument("--max_latency",
+                        help="maximum time in milliseconds an image waits for others to be predicted with",
+                        action="store",
+                        default=10.,
+                        type=float)
+    parser.add_argument("-bs", "--batch_size",
+                        help="patches (cnn_lr_d, default 512) or tiles (u_net, default 4) per model call",
+                        action="store",
+                        default=None,
+                        type=int)
+    parser.add_argument("--overlap",
+                        help="overlap in pixels of the tiles of large images (u_net)",
+                        action="store",
+                        default=64,
+                        type=int)
+    parser.add_argument("--tta",
+                        help="average the predictions of the 8 rotations and flips of the images",
+                        action="store_true")
+    parser.add_argument("--threshold",
+                        help="road probability above which a patch is labelled road in submission rows",
+                        action="store",
+                        default=0.5,
+                        type=float)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = _setup_argparser()
+
+    properties["OUTPUT_DIR"] = latest_run(args.model)
+    if properties["OUTPUT_DIR"] is None:
+        print("[INFO] No trained model {} exists.".format(args.model))
+        sys.exit(1)
+    properties["LOG_DIR"] = os.path.join(properties["OUTPUT_DIR"], "logs")
+
+    predict = load_predictor(args.model, properties["OUTPUT_DIR"], overlap=args.overlap, batch_size=args.batch_size,
+                             tta=args.tta)
+    serve(predict, args.model, host=args.host, port=args.port, max_batch_size=args.max_batch_size,
+          max_latency=args.max_latency / 1000., threshold=args.threshold)
@@ -18,6 +18,18 @@ properties = {
                              os.path.normpath("../assets/tests")),
     "TESTING_DIR": os.path.join(os.path.dirname(sys.modules['__main__'].__file__),
                                 os.path.normpath("../assets/testing")),
+    "CACHE_DIR": os.path.join(os.path.dirname(sys.modules['__main__'].__file__),
+                              os.path.normpath("../assets/cache")),
     "LOG_DIR": None,
 
 }
+
+
+def latest_run(model_name):
+    """Returns the directory of the latest run of a model, None if it has none."""
+    runs_directory = os.path.join(properties["SRC_DIR"], "../trained_models", model_name)
+    if not os.path.exists(runs_directory):
+        return None
+    runs = [os.path.join(runs_directory, run) for run in os.listdir(runs_directory)
+            if os.path.isdir(os.path.join(runs_directory, run))]
+    return max(runs, key=os.path.getmtime) if runs else None
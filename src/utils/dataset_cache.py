@@ -0,0 +1,232 @@
+"""On-disk cache of decoded, padded and normalized datasets.
+
+A dataset is prepared once into `<cache_dir>/<key>/images.npy` and `masks.npy` and then opened memory-mapped, so
+startup does not decode any PNG and several processes share the same pages. The key is derived from the content of
+the source files, the padding and the storage dtype, so changing any of them prepares a new cache entry.
+
+Datasets are decoded by a pool of processes, see `decode_images`, each writing the images it decodes straight into the
+destination array, a memory-mapped cache file or an array in shared memory, so no image is sent back to the caller.
+`decode_shards` decodes the arrays of a sharded dataset the same way, with one pool for all of their shards.
+"""
+
+import ctypes
+import hashlib
+import multiprocessing
+import os
+import shutil
+import time
+
+import matplotlib.image as mpimg
+import numpy as np
+
+from utils.storage import to_storage
+
+CACHE_VERSION = 1
+
+
+def cache_key(image_files, mask_files, pad, dtype):
+    """Returns the key of a dataset in the cache."""
+    key = hashlib.sha1("{} {} {}".format(CACHE_VERSION, pad, np.dtype(dtype).name).encode())
+    for file in list(image_files) + list(mask_files):
+        with open(file, "rb") as f:
+            key.update(hashlib.sha1(f.read()).digest())
+    return key.hexdigest()[:20]
+
+
+def pad_image(image, pad):
+    """Pads the two spatial dimensions of an image by reflection."""
+    if pad == 0:
+        return image
+    return np.pad(image, ((pad, pad), (pad, pad)) + ((0, 0),) * (image.ndim - 2), mode="reflect")
+
+
+# destination array of the decoding processes, see `decode_images`
+_destination = None
+
+
+def _open_destination(destination, shape, dtype):
+    global _destination
+    if isinstance(destination, str):
+        _destination = np.load(destination, mmap_mode="r+")
+    else:
+        _destination = np.frombuffer(destination, dtype=dtype).reshape(shape)
+
+
+def _decode(file, pad, dtype):
+    return to_storage(pad_image(mpimg.imread(file), pad), dtype)
+
+
+def _decode_file(task):
+    idx, file, pad = task
+    _destination[idx] = _decode(file, pad, _destination.dtype)
+
+
+# path and memory-mapped array of the shard a process last wrote to, see `decode_shards`
+_shard = (None, None)
+
+
+def _decode_to_shard(task):
+    global _shard
+    path, idx, file, pad = task
+    if _shard[0] != path:
+        _shard = (path, np.load(path, mmap_mode="r+"))
+    _shard[1][idx] = _decode(file, pad, _shard[1].dtype)
+
+
+def decode_images(files, pad=0, dtype="uint8", path=None, processes=None):
+    """Decodes PNG files into one array, padding them by reflection and converting them to a storage dtype.
+
+    The files are distributed over a pool of processes which write each decoded image directly into the destination
+    array, so only the indices and paths of the files are sent to the processes.
+
+    Args:
+        files (list): paths of the files, all of the same shape.
+        pad (int): reflect padding added around each image.
+        dtype (str): storage dtype, see `utils.storage`.
+        path (path): if given, the array is written to this .npy file and returned memory-mapped, otherwise it is held
+            in shared memory.
+        processes (int): number of decoding processes, defaults to the number of CPUs. The files are decoded in the
+            calling process if it is 1.
+
+    Returns:
+        np.ndarray: the (files, height, width[, channels]) decoded images.
+    """
+    start = time.time()
+    first = _decode(files[0], pad, dtype)
+    shape = (len(files),) + first.shape
+    if path:
+        array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+        array.flush()
+        destination = path
+    else:
+        destination = multiprocessing.RawArray(ctypes.c_uint8, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        array = np.frombuffer(destination, dtype=dtype).reshape(shape)
+    array[0] = first
+
+    processes = min(processes or os.cpu_count() or 1, len(files) - 1)
+    tasks = [(idx, file, pad) for idx, file in enumerate(files) if idx > 0]
+    if processes <= 1:
+        for idx, file, pad in tasks:
+            array[idx] = _decode(file, pad, dtype)
+    else:
+        with multiprocessing.Pool(processes, initializer=_open_destination,
+                                  initargs=(destination, shape, dtype)) as pool:
+            for _ in pool.imap_unordered(_decode_file, tasks, chunksize=max(len(tasks) // (4 * processes), 1)):
+                pass
+    if path:
+        array.flush()
+
+    seconds = time.time() - start
+    print("[INFO] Decoded {} images in {:.2f}s ({:.1f} images/s, {} processes)".format(
+        len(files), seconds, len(files) / max(seconds, 1e-9), max(processes, 1)))
+    return array
+
+
+def decode_shards(arrays, shard_size, pad=0, dtype="uint8", processes=None):
+    """Decodes PNG files into .npy shards of `shard_size` images each, padding them by reflection and converting them
+    to a storage dtype.
+
+    The shards of all arrays are created up front and their files are decoded by a single pool of processes, each
+    writing the images it decodes directly into the memory-mapped shard, see `decode_images`.
+
+    Args:
+        arrays (list): per array, e.g. the images and the masks of a dataset, the paths of its files, all of the same
+            shape, and the paths of its shards.
+        shard_size (int): number of images per shard.
+        pad (int): reflect padding added around each image.
+        dtype (str): storage dtype, see `utils.storage`.
+        processes (int): number of decoding processes, defaults to the number of CPUs. The files are decoded in the
+            calling process if it is 1.
+
+    Returns:
+        list: the shape of an item of each array.
+    """
+    global _shard
+    start = time.time()
+    shapes = []
+    tasks = []
+    for files, paths in arrays:
+        first = _decode(files[0], pad, dtype)
+        shapes.append(first.shape)
+        for shard, path in enumerate(paths):
+            count = min(shard_size, len(files) - shard * shard_size)
+            array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(count,) + first.shape)
+            if shard == 0:
+                array[0] = first
+            array.flush()
+            del array
+        tasks.extend((paths[idx // shard_size], idx % shard_size, file, pad)
+                     for idx, file in enumerate(files) if idx > 0)
+
+    processes = min(processes or os.cpu_count() or 1, len(tasks))
+    if processes <= 1:
+        for task in tasks:
+            _decode_to_shard(task)
+        if _shard[1] is not None:
+            _shard[1].flush()
+        _shard = (None, None)
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            # consecutive tasks write to the same shard, so each process mostly keeps its shard open
+            for _ in pool.imap_unordered(_decode_to_shard, tasks, chunksize=max(len(tasks) // (4 * processes), 1)):
+                pass
+
+    images = sum(len(files) for files, _ in arrays)
+    seconds = time.time() - start
+    print("[INFO] Decoded {} images into {} shards in {:.2f}s ({:.1f} images/s, {} processes)".format(
+        images, sum(len(paths) for _, paths in arrays), seconds, images / max(seconds, 1e-9), max(processes, 1)))
+    return shapes
+
+
+def load_dataset(image_files, mask_files, pad, dtype, cache_dir, processes=None):
+    """Opens a dataset from the cache, preparing it first if it is not cached yet.
+
+    Args:
+        image_files (list): paths of the images.
+        mask_files (list): paths of the masks, in the order of the images, possibly empty.
+        pad (int): reflect padding added around each image and mask.
+        dtype (str): storage dtype, see `utils.storage`.
+        cache_dir (path): directory of the cache.
+        processes (int): number of processes decoding a dataset not cached yet, see `decode_images`.
+
+    Returns:
+        (np.memmap, np.memmap): the read-only images and masks, the masks are an empty list if there are none.
+    """
+    directory = os.path.join(cache_dir, cache_key(image_files, mask_files, pad, dtype))
+    if not os.path.exists(directory):
+        prepare_dataset(image_files, mask_files, pad, dtype, directory, processes)
+
+    images = np.load(os.path.join(directory, "images.npy"), mmap_mode="r")
+    if len(mask_files) > 0:
+        masks = np.load(os.path.join(directory, "masks.npy"), mmap_mode="r")
+    else:
+        masks = []
+    print("[INFO] Opened {} cached images from {}".format(len(images), directory))
+    return images, masks
+
+
+def prepare_dataset(image_files, mask_files, pad, dtype, directory, processes=None):
+    """Decodes, pads and normalizes a dataset into a cache entry.
+
+    The entry is written to a temporary directory first and renamed when complete, so an interrupted preparation is
+    never picked up.
+    """
+    print("[INFO] Preparing cache of {} images in {}".format(len(image_files), directory))
+    tmp_directory = "{}.tmp{}".format(directory, os.getpid())
+    os.makedirs(tmp_directory)
+    try:
+        for name, files in (("images", image_files), ("masks", mask_files)):
+            if len(files) == 0:
+                continue
+            decode_images(files, pad, dtype, os.path.join(tmp_directory, name + ".npy"), processes)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        # another process may have prepared the same entry concurrently
+        if not os.path.exists(directory):
+            raise
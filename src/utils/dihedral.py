@@ -0,0 +1,42 @@
+"""The 8 dihedral transforms of square images, i.e. their rotations by quarter turns and their flipped rotations.
+
+Used for test-time augmentation: the transforms of a batch are stacked into one batch of 8 times its size, predicted
+in a single call and the predictions are transformed back and averaged.
+"""
+
+import numpy as np
+
+DIHEDRAL_COUNT = 8
+
+
+def dihedral(images, k, axes=(1, 2)):
+    """Returns the k-th transform of images: a rotation by `k % 4` quarter turns over `axes`, followed by a flip of the
+    second axis for k >= 4."""
+    images = np.rot90(images, k % 4, axes=axes)
+    return np.flip(images, axes[1]) if k >= 4 else images
+
+
+def inverse_dihedral(images, k, axes=(1, 2)):
+    """Undoes `dihedral(images, k, axes)`."""
+    if k >= 4:
+        images = np.flip(images, axes[1])
+    return np.rot90(images, -(k % 4), axes=axes)
+
+
+def dihedral_views(images, axes=(1, 2)):
+    """Returns the 8 transforms of a batch of square images stacked along the first axis, transform by transform."""
+    return np.concatenate([dihedral(images, k, axes) for k in range(DIHEDRAL_COUNT)])
+
+
+def average_views(predictions, axes=(1, 2)):
+    """Averages the predictions of `dihedral_views` back to one prediction per image.
+
+    Args:
+        predictions (np.ndarray): predictions of the views, transform by transform.
+        axes (tuple): spatial axes of the predictions to transform back, None for predictions without spatial axes,
+            e.g. class probabilities.
+    """
+    views = np.split(predictions, DIHEDRAL_COUNT)
+    if axes is not None:
+        views = [inverse_dihedral(view, k, axes) for k, view in enumerate(views)]
+    return np.mean(views, axis=0)
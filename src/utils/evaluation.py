@@ -0,0 +1,99 @@
+"""Patch-level evaluation of stored predictions against ground truth masks.
+
+A patch is labelled road by the ground truth if its foreground fraction is above a foreground threshold, and by a
+prediction if its road probability is above a prediction threshold. The confusion matrices of all pairs of thresholds
+are computed in one pass: each patch is binned by the number of thresholds below its fraction and below its
+probability, the bins are counted with a single `np.bincount`, and reverse cumulative sums over the bins give, for each
+pair of thresholds, the number of patches above both.
+"""
+
+import matplotlib.image as mpimg
+import numpy as np
+
+THRESHOLDS = np.round(np.arange(0.05, 1., 0.05), 2)
+FOREGROUND_THRESHOLDS = np.round(np.arange(0.05, 0.55, 0.05), 2)
+
+
+def foreground_fractions(mask, patch_size=16):
+    """Returns the (ceil(height / patch_size), ceil(width / patch_size)) foreground fractions of the patches of a mask
+    with values in [0, 1], patches at the border covering only the part inside the mask."""
+    rows = -(-mask.shape[0] // patch_size)
+    cols = -(-mask.shape[1] // patch_size)
+    sums = np.zeros((rows * patch_size, cols * patch_size))
+    counts = np.zeros((rows * patch_size, cols * patch_size))
+    sums[:mask.shape[0], :mask.shape[1]] = mask
+    counts[:mask.shape[0], :mask.shape[1]] = 1
+    blocks = (rows, patch_size, cols, patch_size)
+    return sums.reshape(blocks).sum(axis=(1, 3)) / counts.reshape(blocks).sum(axis=(1, 3))
+
+
+def confusion_matrices(probabilities, fractions, thresholds=THRESHOLDS, foreground_thresholds=FOREGROUND_THRESHOLDS):
+    """Counts the patches of each cell of the confusion matrix for all pairs of thresholds.
+
+    Args:
+        probabilities (np.ndarray): predicted road probabilities of the patches, any shape.
+        fractions (np.ndarray): ground truth foreground fractions of the same patches.
+        thresholds (np.ndarray): increasing prediction thresholds.
+        foreground_thresholds (np.ndarray): increasing foreground thresholds.
+
+    Returns:
+        dict: `tp`, `fp`, `fn` and `tn` counts of shape (foreground thresholds, thresholds).
+    """
+    # number of thresholds strictly below each value, i.e. how many thresholds label it road
+    predicted_bins = np.searchsorted(thresholds, np.ravel(probabilities), side="left")
+    truth_bins = np.searchsorted(foreground_thresholds, np.ravel(fractions), side="left")
+    n_thresholds = len(thresholds) + 1
+    counts = np.bincount(truth_bins * n_thresholds + predicted_bins,
+                         minlength=(len(foreground_thresholds) + 1) * n_thresholds).reshape(-1, n_thresholds)
+
+    # above[i, j]: patches in truth bins >= i and predicted bins >= j
+    above = counts[::-1, ::-1].cumsum(axis=0).cumsum(axis=1)[::-1, ::-1]
+    total = above[0, 0]
+    tp = above[1:, 1:]
+    truth_positives = above[1:, :1]
+    predicted_positives = above[:1, 1:]
+    fp = predicted_positives - tp
+    fn = truth_positives - tp
+    return {"tp": tp, "fp": fp, "fn": fn, "tn": total - tp - fp - fn}
+
+
+def scores(matrices):
+    """Returns the F1 score and the accuracy of confusion matrices from `confusion_matrices`."""
+    tp, fp, fn, tn = (matrices[key].astype(np.float64) for key in ("tp", "fp", "fn", "tn"))
+    f1 = np.divide(2 * tp, 2 * tp + fp + fn, out=np.zeros_like(tp), where=2 * tp + fp + fn > 0)
+    accuracy = (tp + tn) / np.maximum(tp + fp + fn + tn, 1)
+    return f1, accuracy
+
+
+def evaluate_store(store, mask_files, image_ids, patch_size=16, thresholds=THRESHOLDS,
+                   foreground_thresholds=FOREGROUND_THRESHOLDS):
+    """Evaluates stored predictions against the ground truth masks of the same images.
+
+    Args:
+        store (utils.prediction_store.PredictionStore): the predictions.
+        mask_files (list): paths of the masks.
+        image_ids (list): number of the image of each mask in the store.
+
+    Returns:
+        (np.ndarray, np.ndarray, dict): the F1 scores and accuracies of shape (foreground thresholds, thresholds) and
+        the confusion matrices.
+    """
+    probabilities = []
+    fractions = []
+    for image_id, mask_file in zip(image_ids, mask_files):
+        mask = mpimg.imread(mask_file)
+        fractions.append(foreground_fractions(mask if mask.ndim == 2 else mask[..., 0], patch_size).ravel())
+        probabilities.append(np.ravel(store.grid(image_id)))
+
+    matrices = confusion_matrices(np.concatenate(probabilities), np.concatenate(fractions), thresholds,
+                                  foreground_thresholds)
+    f1, accuracy = scores(matrices)
+    return f1, accuracy, matrices
+
+
+def report(f1, accuracy, thresholds=THRESHOLDS, foreground_thresholds=FOREGROUND_THRESHOLDS):
+    """Prints the best prediction threshold for each foreground threshold."""
+    for idx, foreground_threshold in enumerate(foreground_thresholds):
+        best = int(np.argmax(f1[idx]))
+        print("[INFO] Foreground threshold {:.2f}: best threshold {:.2f} with F1 {:.4f}, accuracy {:.4f}".format(
+            foreground_threshold, thresholds[best], f1[idx, best], accuracy[idx, best]))
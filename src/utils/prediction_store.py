@@ -0,0 +1,197 @@
+"""On-disk store of the patch probabilities of a prediction run.
+
+The road probability of every patch is kept as float16 in `<directory>/predictions.f16`, one grid after the other,
+and `<directory>/predictions.ids.npy` holds the number, rows, columns and offset of the grid of each image. The
+probabilities are memory-mapped on load, so submissions for other thresholds and ensembles of several runs are written
+without running the models again.
+
+`<directory>/predictions.json` records the options the predictions were made with, e.g. the images and the weights,
+so they are only reused for the same options, see `PredictionStore.matches`.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from utils.submission import MERGE_RULES, SubmissionWriter
+
+PROBABILITIES_FILE = "predictions.f16"
+IDS_FILE = "predictions.ids.npy"
+OPTIONS_FILE = "predictions.json"
+
+
+def road_probabilities(grid):
+    """Returns the road probabilities of a (rows, columns) grid of road probabilities or a (rows, columns, classes)
+    grid of class probabilities."""
+    return grid[..., 1] if grid.ndim == 3 else grid
+
+
+class PredictionStoreWriter(object):
+    """Appends the predictions of images to a store, replacing the previous store of the directory on close.
+
+    Usable as a context manager, which closes the store on exit, or aborts it if the predictions failed.
+    """
+
+    def __init__(self, directory, options=None):
+        """Start a store.
+
+        Args:
+            directory (path): directory of the store.
+            options (dict): JSON serializable options the predictions are made with, see `PredictionStore.matches`.
+        """
+        self.directory = directory
+        self.options = options or {}
+        self.tmp_suffix = ".tmp{}".format(os.getpid())
+        self.file = open(os.path.join(directory, PROBABILITIES_FILE + self.tmp_suffix), "wb")
+        self.ids = []
+        self.offset = 0
+
+    def write(self, image_id, grid):
+        """Stores the predictions of an image, see `road_probabilities`.
+
+        Returns:
+            np.ndarray: the stored float16 road probabilities, labelling these rather than `grid` gives the same
+            submission as `PredictionStore.write_submission`.
+        """
+        probabilities = np.ascontiguousarray(road_probabilities(grid), dtype=np.float16)
+        self.file.write(probabilities.tobytes())
+        self.ids.append((int(image_id),) + probabilities.shape + (self.offset,))
+        self.offset += probabilities.size
+        return probabilities
+
+    def close(self):
+        self.file.close()
+        options_file = os.path.join(self.directory, OPTIONS_FILE)
+        # the options are removed before and written after the predictions are replaced, so an interrupted close never
+        # leaves options matching predictions they do not describe
+        if os.path.exists(options_file):
+            os.remove(options_file)
+        ids_file = os.path.join(self.directory, IDS_FILE)
+        np.save(ids_file + self.tmp_suffix + ".npy", np.array(self.ids, dtype=np.int64).reshape(-1, 4))
+        os.replace(os.path.join(self.directory, PROBABILITIES_FILE + self.tmp_suffix),
+                   os.path.join(self.directory, PROBABILITIES_FILE))
+        os.replace(ids_file + self.tmp_suffix + ".npy", ids_file)
+        with open(options_file + self.tmp_suffix, "w") as file:
+            json.dump(self.options, file, indent=2, sort_keys=True)
+        os.replace(options_file + self.tmp_suffix, options_file)
+        print("[INFO] Stored the predictions of {} images in {}".format(len(self.ids), self.directory))
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        """Closes the store without replacing the previous one, removing the predictions written so far."""
+        self.file.close()
+        try:
+            os.remove(os.path.join(self.directory, PROBABILITIES_FILE + self.tmp_suffix))
+        except OSError:
+            pass
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class PredictionStore(object):
+    """Read access to the predictions stored in a directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.ids = np.load(os.path.join(directory, IDS_FILE))
+        if self.ids[:, 1:3].prod(axis=1).sum() > 0:
+            self.probabilities = np.memmap(os.path.join(directory, PROBABILITIES_FILE), dtype=np.float16, mode="r")
+        else:
+            self.probabilities = np.empty(0, dtype=np.float16)
+        self.positions = {image_id: idx for idx, image_id in enumerate(self.ids[:, 0].tolist())}
+        options_file = os.path.join(directory, OPTIONS_FILE)
+        if os.path.exists(options_file):
+            with open(options_file) as file:
+                self.options = json.load(file)
+        else:
+            self.options = {}
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, IDS_FILE))
+
+    @staticmethod
+    def matches(directory, options):
+        """Returns whether `directory` holds a store of predictions made with the given options."""
+        # compared as stored, e.g. tuples as lists
+        return (PredictionStore.exists(directory) and
+                PredictionStore(directory).options == json.loads(json.dumps(options)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, image_id):
+        return int(image_id) in self.positions
+
+    def grid(self, image_id):
+        """Returns the (rows, columns) road probabilities of an image.
+
+        Raises:
+            KeyError: if the image is not in the store.
+        """
+        _, rows, cols, offset = self.ids[self.positions[int(image_id)]]
+        return self.probabilities[offset:offset + rows * cols].reshape(rows, cols)
+
+    def grids(self):
+        """Yields the number and the road probabilities of each image, in the order they were predicted."""
+        for image_id in self.ids[:, 0].tolist():
+            yield image_id, self.grid(image_id)
+
+    def write_submission(self, submission_file, patch_size=16, threshold=0.5):
+        """Writes the submission of the stored predictions labelling patches above `threshold` as road."""
+        with SubmissionWriter(submission_file, patch_size, threshold) as writer:
+            for image_id, grid in self.grids():
+                writer.write(image_id, grid)
+        print("[INFO] Wrote the submission of {} stored images with threshold {} to {}".format(len(self), threshold,
+                                                                                            submission_file))
+
+
+def merge_stores(directories, submission_file, rule="average", weights=None, patch_size=16, threshold=0.5):
+    """Writes the submission of an ensemble of prediction runs, one image at a time.
+
+    Unlike `utils.submission.merge_submissions`, the `average` rule averages the probabilities of the runs rather than
+    their labels.
+
+    Args:
+        directories (list): directories of the stores, which must hold the same images.
+        submission_file (path): the submission to write.
+        rule (str): one of `utils.submission.MERGE_RULES`.
+        weights (list): weight of each run, equal weights by default.
+        patch_size (int): side of the patches in pixels.
+        threshold (float): probabilities above this value count as road.
+
+    Raises:
+        ValueError: if the rule is unknown or the stores do not hold the same images.
+    """
+    if rule not in MERGE_RULES:
+        raise ValueError("Unknown merge rule {}, expected one of {}".format(rule, ", ".join(MERGE_RULES)))
+    weights = np.ones(len(directories)) if weights is None else np.asarray(weights, dtype=np.float64)
+    if len(weights) != len(directories):
+        raise ValueError("Got {} weights for {} prediction runs".format(len(weights), len(directories)))
+
+    stores = [PredictionStore(directory) for directory in directories]
+    for store in stores[1:]:
+        if not np.array_equal(store.ids[:, :3], stores[0].ids[:, :3]):
+            raise ValueError("Prediction runs {} and {} do not hold the same images".format(stores[0].directory,
+                                                                                           store.directory))
+
+    with SubmissionWriter(submission_file, patch_size) as writer:
+        for image_id in stores[0].ids[:, 0].tolist():
+            probabilities = np.stack([store.grid(image_id) for store in stores]).astype(np.float32)
+            if rule == "or":
+                merged = np.any(probabilities > threshold, axis=0)
+            elif rule == "majority":
+                merged = np.tensordot(weights, probabilities > threshold, axes=1) > weights.sum() / 2
+            else:
+                merged = np.tensordot(weights, probabilities, axes=1) / weights.sum() > threshold
+            writer.write(image_id, merged.astype(np.float32))
+
+    print("[INFO] Merged {} images of {} prediction runs with rule {} into {}".format(len(stores[0]), len(stores),
+                                                                                    rule, submission_file))
@@ -0,0 +1,35 @@
+"""Seedable random number streams of the data generators.
+
+Each generator owns a `np.random.SeedSequence` built from an explicit seed and draws from `np.random.Generator`s
+spawned from it, never from the global `np.random` state: one stream per purpose, e.g. per split, and one substream
+per batch, so streams are independent, and runs with the same seed draw the same batches whatever the number of
+workers preparing them.
+"""
+
+import numpy as np
+
+
+def seed_sequence(seed=None):
+    """Returns the root seed sequence of a generator.
+
+    Args:
+        seed: an int, a `np.random.SeedSequence` returned as is, or None for fresh entropy, which is printed so that
+            the run can be repeated with it.
+    """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    sequence = np.random.SeedSequence(seed)
+    if seed is None:
+        print("[INFO] Seeding the data generator with {}, pass it as seed to repeat this run".format(sequence.entropy))
+    return sequence
+
+
+def spawn_rngs(sequence, count):
+    """Returns `count` independent generators spawned from a seed sequence."""
+    return [np.random.default_rng(child) for child in sequence.spawn(count)]
+
+
+def substreams(sequence):
+    """Yields independent generators spawned from a seed sequence endlessly, e.g. one per batch."""
+    while True:
+        yield np.random.default_rng(sequence.spawn(1)[0])
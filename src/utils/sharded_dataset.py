@@ -0,0 +1,226 @@
+"""Sharded on-disk datasets, for training sets too large to be held in memory.
+
+A dataset directory holds an index file, `index.json`, and its images and masks in shards of `shard_size` items each,
+`images_00000.npy`, `masks_00000.npy`, ... The index records the number of items, the shard size, the padding, the
+storage dtype and the shape of an item of each array.
+
+Shards are opened memory-mapped on first access and kept open in a least recently used cache, so any item is read
+without loading the others and the number of open shards stays bounded whatever the size of the dataset. The arrays of
+a dataset support the indexing used by the generators: an integer, a slice or an array of indices on the first axis,
+optionally followed by indices of the other axes.
+"""
+
+import collections
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from utils.dataset_cache import decode_shards
+
+INDEX_FILE = "index.json"
+SHARD_VERSION = 1
+
+
+def shard_file(name, shard):
+    """Returns the file name of a shard of an array."""
+    return "{}_{:05d}.npy".format(name, shard)
+
+
+def write_sharded_dataset(image_files, mask_files, directory, pad=0, dtype="uint8", shard_size=64, processes=None):
+    """Decodes, pads and normalizes images and masks into a sharded dataset.
+
+    The dataset is written to a temporary directory first and renamed when complete, so an interrupted preparation is
+    never picked up.
+
+    Args:
+        image_files (list): paths of the images.
+        mask_files (list): paths of the masks, in the order of the images, possibly empty.
+        directory (path): directory of the dataset, must not exist.
+        pad (int): reflect padding added around each image and mask.
+        dtype (str): storage dtype, see `utils.storage`.
+        shard_size (int): number of images per shard.
+        processes (int): number of decoding processes, see `utils.dataset_cache.decode_shards`.
+    """
+    print("[INFO] Writing sharded dataset of {} images to {}".format(len(image_files), directory))
+    start = time.time()
+    tmp_directory = "{}.tmp{}".format(os.path.normpath(directory), os.getpid())
+    os.makedirs(tmp_directory)
+    index = {"version": SHARD_VERSION, "count": len(image_files), "shard_size": shard_size, "pad": pad,
+             "dtype": np.dtype(dtype).name, "arrays": {},
+             "files": [os.path.basename(image_file) for image_file in image_files]}
+    try:
+        arrays = [(name, files) for name, files in (("images", image_files), ("masks", mask_files)) if len(files) > 0]
+        shapes = decode_shards([(files, [os.path.join(tmp_directory, shard_file(name, shard))
+                                         for shard in range(-(-len(files) // shard_size))])
+                                for name, files in arrays], shard_size, pad, dtype, processes)
+        for (name, _), shape in zip(arrays, shapes):
+            index["arrays"][name] = list(shape)
+
+        with open(os.path.join(tmp_directory, INDEX_FILE), "w") as file:
+            json.dump(index, file, indent=2)
+        os.rename(tmp_directory, directory)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+    print("[INFO] Wrote {} shards in {:.1f}s".format(-(-len(image_files) // shard_size), time.time() - start))
+
+
+class ShardCache(object):
+    """Least recently used cache of memory-mapped shards, shared by the arrays of a dataset and safe to use from
+    several threads."""
+
+    def __init__(self, capacity=16):
+        """Initialise the cache.
+
+        Args:
+            capacity (int): number of shards kept open.
+        """
+        self.capacity = capacity
+        self.shards = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """Returns the memory-mapped shard at `path`, opening it if it is not cached."""
+        with self.lock:
+            shard = self.shards.get(path)
+            if shard is not None:
+                self.hits += 1
+                self.shards.move_to_end(path)
+                return shard
+
+            self.misses += 1
+            shard = np.load(path, mmap_mode="r")
+            self.shards[path] = shard
+            if len(self.shards) > self.capacity:
+                # readers still holding an evicted shard keep it mapped until they release it
+                self.shards.popitem(last=False)
+            return shard
+
+
+class ShardedArray(object):
+    """One array of a sharded dataset, e.g. its images, read shard by shard through a `ShardCache`."""
+
+    def __init__(self, directory, name, count, shard_size, item_shape, dtype, cache):
+        self.directory = directory
+        self.name = name
+        self.shard_size = shard_size
+        self.shape = (count,) + tuple(item_shape)
+        self.dtype = np.dtype(dtype)
+        self.cache = cache
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def shard(self, shard):
+        """Returns the memory-mapped items of a shard."""
+        return self.cache.get(os.path.join(self.directory, shard_file(self.name, shard)))
+
+    def __iter__(self):
+        for shard in range(-(-len(self) // self.shard_size)):
+            for item in self.shard(shard):
+                yield item
+
+    def __getitem__(self, key):
+        first, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if first is Ellipsis:
+            first, rest = slice(None), (Ellipsis,) + rest
+
+        if isinstance(first, slice):
+            return self.take(np.arange(*first.indices(len(self))))[(slice(None),) + rest]
+
+        if np.ndim(first) == 0:
+            idx = self.check_indices(first)
+            return self.shard(idx // self.shard_size)[(idx % self.shard_size,) + rest]
+
+        first = np.asarray(first)
+        if first.dtype == bool:
+            first = np.flatnonzero(first)
+        if all(not isinstance(index, slice) and index is not Ellipsis and index is not None for index in rest):
+            # only advanced indices, which broadcast together: each element is gathered from its own shard
+            indices = np.broadcast_arrays(self.check_indices(first), *rest)
+            result = np.empty(indices[0].shape + self.shape[1 + len(rest):], dtype=self.dtype)
+            shards = indices[0] // self.shard_size
+            for shard in np.unique(shards):
+                selected = shards == shard
+                result[selected] = self.shard(shard)[(indices[0][selected] % self.shard_size,) +
+                                                     tuple(index[selected] for index in indices[1:])]
+            return result
+
+        unique, inverse = np.unique(first, return_inverse=True)
+        return self.take(unique)[(inverse.reshape(first.shape),) + rest]
+
+    def check_indices(self, indices):
+        """Returns the indices of items, negative ones counted from the end, raising an IndexError if out of bounds."""
+        indices = np.asarray(indices, dtype=np.intp)
+        if np.any(indices >= len(self)) or np.any(indices < -len(self)):
+            raise IndexError("Index out of bounds for sharded array of {} items".format(len(self)))
+        indices = np.where(indices < 0, indices + len(self), indices)
+        return int(indices) if indices.ndim == 0 else indices
+
+    def take(self, indices):
+        """Returns a copy of the items at the given 1-d indices, reading each shard once."""
+        indices = self.check_indices(np.ravel(indices))
+        items = np.empty((len(indices),) + self.shape[1:], dtype=self.dtype)
+        shards = indices // self.shard_size
+        for shard in np.unique(shards):
+            selected = np.flatnonzero(shards == shard)
+            items[selected] = self.shard(shard)[indices[selected] % self.shard_size]
+        return items
+
+    def max(self):
+        """Returns the largest value of the array, reading it shard by shard."""
+        return max(self.shard(shard).max() for shard in range(-(-len(self) // self.shard_size)))
+
+
+class ShardedDataset(object):
+    """A sharded dataset opened for random access, see `write_sharded_dataset`."""
+
+    def __init__(self, directory, cache_shards=16):
+        """Open the dataset.
+
+        Args:
+            directory (path): directory of the dataset.
+            cache_shards (int): number of shards kept open by the LRU cache shared by the images and the masks.
+        """
+        with open(os.path.join(directory, INDEX_FILE)) as file:
+            self.index = json.load(file)
+        if self.index["version"] != SHARD_VERSION:
+            raise ValueError("Sharded dataset {} has version {}, expected {}".format(directory, self.index["version"],
+                                                                                    SHARD_VERSION))
+        self.directory = directory
+        self.pad = self.index["pad"]
+        self.cache = ShardCache(cache_shards)
+        arrays = {name: ShardedArray(directory, name, self.index["count"], self.index["shard_size"], item_shape,
+                                     self.index["dtype"], self.cache)
+                  for name, item_shape in self.index["arrays"].items()}
+        self.images = arrays["images"]
+        self.masks = arrays.get("masks", [])
+        print("[INFO] Opened sharded dataset of {} images from {}".format(len(self), directory))
+
+    def check(self, pad, dtype):
+        """Raises a ValueError if the dataset is not padded by `pad` pixels or not stored in `dtype`."""
+        if self.pad != pad:
+            raise ValueError("Sharded dataset {} is padded by {} pixels, expected {}".format(self.directory, self.pad,
+                                                                                            pad))
+        if self.images.dtype != np.dtype(dtype):
+            raise ValueError("Sharded dataset {} is stored as {}, expected {}".format(self.directory,
+                                                                                     self.images.dtype.name,
+                                                                                     np.dtype(dtype).name))
+
+    @staticmethod
+    def exists(directory):
+        """Returns whether a complete sharded dataset exists in `directory`."""
+        return os.path.exists(os.path.join(directory, INDEX_FILE))
+
+    def __len__(self):
+        return self.index["count"]
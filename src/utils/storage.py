@@ -0,0 +1,47 @@
+"""Storage dtype policy of the image generators.
+
+Datasets are kept in memory in a compact storage dtype and only converted to the float32 input of the models one
+batch at a time. Images stored as uint8 hold the values of the source PNGs (0 - 255), float images hold values in
+[0, 1].
+"""
+
+import numpy as np
+
+STORAGE_DTYPES = ("uint8", "float32", "float64")
+
+
+def value_scale(dtype):
+    """Returns the stored value corresponding to an intensity of 1."""
+    return 255 if np.dtype(dtype) == np.uint8 else 1
+
+
+def to_storage(image, dtype):
+    """Converts an image with values in [0, 1] to the storage dtype."""
+    if np.dtype(dtype) == np.uint8:
+        return np.rint(np.multiply(image, 255, dtype=np.float32)).astype(np.uint8)
+    return np.asarray(image, dtype=dtype)
+
+
+def cast(values, dtype):
+    """Converts values already in the scale of the storage dtype to it, e.g. after interpolation."""
+    if np.dtype(dtype) == np.uint8:
+        return np.clip(np.rint(values), 0, 255).astype(np.uint8)
+    return np.asarray(values, dtype=dtype)
+
+
+def to_model(images, out=None):
+    """Converts stored images to the float32 input of the models, with values in [0, 1].
+
+    Args:
+        images (np.ndarray): images in a storage dtype.
+        out (np.ndarray): optional float32 array to write the result to.
+
+    Returns:
+        np.ndarray: the converted images.
+    """
+    if images.dtype == np.uint8:
+        return np.divide(images, 255, out=out, dtype=np.float32)
+    if out is None:
+        return images.astype(np.float32)
+    out[...] = images
+    return out
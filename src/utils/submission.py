@@ -0,0 +1,272 @@
+"""Writing and merging of submission files.
+
+A submission holds one `<image>_<x>_<y>,<label>` row per patch, with the patches of an image listed column by column.
+The rows of an image are built with vectorized string operations and written in a single call. Submissions of the
+same images list the same ids in the same order, so they are merged by streaming them side by side.
+
+The labels of a submission are indexed once into `.npy` sidecar files next to it, after which the grid of any image is
+looked up without reading the submission again.
+"""
+
+import gzip
+import itertools
+import os
+
+import numpy as np
+
+MERGE_RULES = ("or", "majority", "average")
+# submissions only hold 0/1 labels, whose weighted average is the weighted majority, so `average` is left to the
+# probabilities of prediction stores, see `utils.prediction_store.merge_stores`
+SUBMISSION_MERGE_RULES = ("or", "majority")
+
+
+def open_submission(submission_file, mode="r"):
+    """Opens a submission file for reading or writing text, gzip compressed if its name ends with `.gz`."""
+    if submission_file.endswith(".gz"):
+        return gzip.open(submission_file, mode + "t")
+    return open(submission_file, mode)
+
+
+def submission_rows(f):
+    """Yields the rows of an opened submission after its header, skipping blank lines."""
+    for line in f:
+        if line.strip():
+            yield line
+
+
+class SubmissionFormatter(object):
+    """Formats the predictions of images as submission rows."""
+
+    def __init__(self, patch_size=16, threshold=0.5):
+        """Initialise the formatter.
+
+        Args:
+            patch_size (int): side of the patches in pixels.
+            threshold (float): a patch of a grid of road probabilities is labelled road above this probability.
+        """
+        self.patch_size = patch_size
+        self.threshold = threshold
+        self.suffixes = {}
+
+    def labels(self, grid):
+        """Returns the 0/1 labels of a (rows, columns) grid of road probabilities or a (rows, columns, classes) grid of
+        class probabilities."""
+        if grid.ndim == 3:
+            return np.argmax(grid, axis=-1)
+        return (grid > self.threshold).astype(np.intp)
+
+    def format(self, image_id, grid):
+        """Returns the rows of an image.
+
+        Args:
+            image_id (int or str): number of the image.
+            grid (np.ndarray): predictions of the patches of the image indexed by their row and column, see `labels`.
+        """
+        labels = self.labels(grid)
+        return self.format_rows(np.char.add("{:03d}".format(int(image_id)), self.row_suffixes(labels.shape)),
+                                labels.T.ravel())
+
+    @staticmethod
+    def format_rows(ids, labels):
+        """Returns rows given the ids and the 0/1 labels of the patches. Each id must already end with a comma."""
+        return "".join(np.char.add(ids, np.array(["0\n", "1\n"])[labels]).tolist())
+
+    def row_suffixes(self, shape):
+        """Returns the `_<x>_<y>,` parts of the rows of a grid of the given shape, in the order of the rows."""
+        if shape not in self.suffixes:
+            rows = np.arange(shape[0]) * self.patch_size
+            cols = np.arange(shape[1]) * self.patch_size
+            suffixes = np.char.add(np.char.add("_", cols.astype(str))[:, None], "_")
+            suffixes = np.char.add(np.char.add(suffixes, rows.astype(str)[None, :]), ",")
+            self.suffixes[shape] = suffixes.ravel()
+        return self.suffixes[shape]
+
+
+class SubmissionWriter(SubmissionFormatter):
+    """Writes the predictions of images to a submission file, gzip compressed if the file name ends with `.gz`.
+
+    Usable as a context manager, which closes the file on exit.
+    """
+
+    def __init__(self, submission_file, patch_size=16, threshold=0.5):
+        """Opens the submission file and writes its header.
+
+        Args:
+            submission_file (path): the file to write.
+            patch_size (int): side of the patches in pixels.
+            threshold (float): a patch of a grid of road probabilities is labelled road above this probability.
+        """
+        super().__init__(patch_size, threshold)
+        self.file = open_submission(submission_file, "w")
+        self.file.write("Id,Prediction\n")
+
+    def write(self, image_id, grid):
+        """Writes the rows of an image, see `format`."""
+        self.file.write(self.format(image_id, grid))
+
+    def write_rows(self, ids, labels):
+        """Writes rows given the ids and the 0/1 labels of the patches, see `format_rows`."""
+        self.file.write(self.format_rows(ids, labels))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def merge_submissions(submission_files, merged_file, rule="or", weights=None, threshold=0.5, chunk_size=65536):
+    """Combines submissions of the same images patch by patch.
+
+    The submissions are read side by side `chunk_size` rows at a time, so memory use does not depend on their size.
+
+    Args:
+        submission_files (list): paths of the submissions, plain or gzip compressed.
+        merged_file (path): the submission to write.
+        rule (str): `or` labels a patch road if any submission does, `majority` if the weighted majority of the
+            submissions does. The `average` of probabilities is only available for prediction stores, see
+            `utils.prediction_store.merge_stores`.
+        weights (list): weight of each submission, equal weights by default.
+        threshold (float): predictions above this value count as road.
+        chunk_size (int): number of rows processed at once.
+
+    Raises:
+        ValueError: if the rule is unknown or the submissions do not list the same ids.
+    """
+    if rule == "average":
+        raise ValueError("Submissions hold labels, whose average is their majority, merge the directories of the "
+                         "prediction runs to average their probabilities")
+    if rule not in SUBMISSION_MERGE_RULES:
+        raise ValueError("Unknown merge rule {}, expected one of {}".format(rule, ", ".join(SUBMISSION_MERGE_RULES)))
+    weights = np.ones(len(submission_files)) if weights is None else np.asarray(weights, dtype=np.float64)
+    if len(weights) != len(submission_files):
+        raise ValueError("Got {} weights for {} submissions".format(len(weights), len(submission_files)))
+
+    files = [open_submission(submission_file) for submission_file in submission_files]
+    try:
+        for f in files:
+            next(f)  # header
+        readers = [submission_rows(f) for f in files]
+        with SubmissionWriter(merged_file) as writer:
+            rows = 0
+            while True:
+                chunks = [list(itertools.islice(reader, chunk_size)) for reader in readers]
+                if not any(chunks):
+                    break
+                if any(len(chunk) != len(chunks[0]) for chunk in chunks):
+                    raise ValueError("Submissions {} have different numbers of rows".format(
+                        ", ".join(submission_files)))
+
+                predictions = np.empty((len(files), len(chunks[0])))
+                for idx, chunk in enumerate(chunks):
+                    chunk_ids, predictions[idx] = split_rows(chunk)
+                    if idx == 0:
+                        ids = chunk_ids
+                    elif not np.array_equal(chunk_ids, ids):
+                        raise ValueError("Submission {} does not list the ids of {} in the same order, rows {} to "
+                                         "{}".format(submission_files[idx], submission_files[0], rows,
+                                                     rows + len(ids)))
+
+                if rule == "or":
+                    labels = np.any(predictions > threshold, axis=0)
+                else:
+                    labels = weights.dot(predictions > threshold) > weights.sum() / 2
+                writer.write_rows(ids, labels.astype(np.intp))
+                rows += len(ids)
+    finally:
+        for f in files:
+            f.close()
+
+    print("[INFO] Merged {} rows of {} submissions with rule {} into {}".format(rows, len(files), rule, merged_file))
+
+
+def split_rows(lines):
+    """Returns the ids, each ending with its comma, and the predictions of submission rows, skipping blank lines."""
+    ids, predictions = zip(*(line.rstrip().rsplit(",", 1) for line in lines if line.strip()))
+    return np.char.add(np.array(ids), ","), np.array(predictions, dtype=np.float64)
+
+
+class SubmissionIndex(object):
+    """Labels of a submission as one grid per image.
+
+    The grids are stored in `<submission>.index.npy`, an int8 array of shape (images, rows, columns) memory-mapped on
+    load, with -1 marking cells beyond the grid of smaller images, and `<submission>.ids.npy` holds the number, rows
+    and columns of each image. The sidecars are rebuilt when the submission is newer than them.
+    """
+
+    def __init__(self, submission_file, patch_size=16, chunk_size=65536):
+        """Opens the index of a submission, building it first if needed.
+
+        Args:
+            submission_file (path): the submission, plain or gzip compressed.
+            patch_size (int): side of the patches in pixels.
+            chunk_size (int): number of rows parsed at once when building the index.
+        """
+        self.patch_size = patch_size
+        grids_file = submission_file + ".index.npy"
+        ids_file = submission_file + ".ids.npy"
+        if not all(os.path.exists(f) and os.path.getmtime(f) >= os.path.getmtime(submission_file)
+                   for f in (grids_file, ids_file)):
+            grids, ids = self.build(submission_file, patch_size, chunk_size)
+            for path, array in ((grids_file, grids), (ids_file, ids)):
+                tmp_path = "{}.tmp{}.npy".format(path[:-len(".npy")], os.getpid())
+                np.save(tmp_path, array)
+                os.replace(tmp_path, path)
+            print("[INFO] Indexed {} images of {}".format(len(ids), submission_file))
+
+        self.grids = np.load(grids_file, mmap_mode="r")
+        self.ids = np.load(ids_file)
+        self.positions = {image_id: idx for idx, image_id in enumerate(self.ids[:, 0].tolist())}
+
+    @staticmethod
+    def build(submission_file, patch_size=16, chunk_size=65536):
+        """Parses a submission.
+
+        Returns:
+            (np.ndarray, np.ndarray): the (images, rows, columns) int8 grids of labels and the (images, 3) numbers,
+            rows and columns of the images, see `SubmissionIndex`.
+        """
+        chunks = []
+        with open_submission(submission_file) as f:
+            next(f)  # header
+            reader = submission_rows(f)
+            while True:
+                lines = list(itertools.islice(reader, chunk_size))
+                if not lines:
+                    break
+                # <image>_<x>_<y>,<label> rows as an (n, 4) array
+                fields = "".join(lines).replace("\r", "").replace("_", ",").replace("\n", ",").split(",")[:-1]
+                chunks.append(np.array(fields, dtype=np.float64).reshape(-1, 4))
+        rows = np.concatenate(chunks) if chunks else np.empty((0, 4))
+
+        numbers, positions = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+        cols = (rows[:, 1] // patch_size).astype(np.intp)
+        rows_idx = (rows[:, 2] // patch_size).astype(np.intp)
+        ids = np.zeros((len(numbers), 3), dtype=np.int64)
+        ids[:, 0] = numbers
+        np.maximum.at(ids[:, 1], positions, rows_idx + 1)
+        np.maximum.at(ids[:, 2], positions, cols + 1)
+
+        grids = np.full((len(numbers), ids[:, 1].max(initial=0), ids[:, 2].max(initial=0)), -1, dtype=np.int8)
+        grids[positions, rows_idx, cols] = rows[:, 3] > 0.5
+        return grids, ids
+
+    def __contains__(self, image_id):
+        return int(image_id) in self.positions
+
+    def grid(self, image_id):
+        """Returns the (rows, columns) 0/1 labels of an image.
+
+        Raises:
+            KeyError: if the image is not in the submission.
+        """
+        idx = self.positions[int(image_id)]
+        return self.grids[idx, :self.ids[idx, 1], :self.ids[idx, 2]]
+
+    def diff(self, other, image_id):
+        """Returns the labels of an image in the `other` index minus its labels in this one, i.e. 1 for road patches
+        only in `other` and -1 for road patches only in this index."""
+        return other.grid(image_id).astype(np.int8) - self.grid(image_id)
@@ -1,30 +1,23 @@
-import csv
 import glob
 
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
+import numpy as np
 
 from utils.commons import *
+from utils.prediction_store import PredictionStore
+from utils.submission import SubmissionIndex
 
 
-def filter_id_entries(id_img, csv_file):
-    x_entries_roads = []
-    y_entries_roads = []
-    with open(csv_file) as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-
-            if int(id_img) == int(row['Id'][0:row['Id'].index("_")]):
-                if int(row["Prediction"]) == 1:
-                    id_y_x = row["Id"].split("_")
-                    y_entries_roads.append(int(id_y_x[1]))
-                    x_entries_roads.append(int(id_y_x[2]))
-
-    if len(x_entries_roads) == 0:
+def filter_id_entries(id_img, csv_file, patch_size=16):
+    """Returns the pixel rows and columns of the road patches of an image, looked up in the index of the submission."""
+    index = SubmissionIndex(csv_file, patch_size)
+    if id_img not in index:
         print("Sorry the provided id of the image has not been found in the csv")
         sys.exit(1)
 
-    return x_entries_roads, y_entries_roads
+    x_entries_roads, y_entries_roads = np.nonzero(index.grid(id_img) == 1)
+    return list(x_entries_roads * patch_size), list(y_entries_roads * patch_size)
 
 
 def get_image_ids(data_files):
@@ -38,13 +31,17 @@ def get_image_ids(data_files):
     return images_ids
 
 
-def visualize(id_img, csv_file, path_to_images, patch_size):
-    x, y = filter_id_entries(id_img=int(id_img), csv_file=csv_file)
-
+def load_image(id_img, path_to_images):
     images = glob.glob(os.path.join(path_to_images, "*.png"))
     images_ids = get_image_ids(images)
 
-    img = mpimg.imread(images[images_ids.index(id_img)])
+    return mpimg.imread(images[images_ids.index(id_img)])
+
+
+def visualize(id_img, csv_file, path_to_images, patch_size):
+    x, y = filter_id_entries(id_img=int(id_img), csv_file=csv_file, patch_size=patch_size)
+
+    img = load_image(id_img, path_to_images)
 
     total_entries = len(x)
 
@@ -53,3 +50,40 @@ def visualize(id_img, csv_file, path_to_images, patch_size):
         img[x[idx]:x[idx] + patch_size, y[idx]:y[idx] + patch_size, 0] = 0
     plt.imshow(img)
     plt.show()
+
+
+def visualize_diff(id_img, csv_file, other_csv_file, path_to_images, patch_size):
+    """Shows the road patches of an image only predicted in `other_csv_file` in green and only in `csv_file` in red."""
+    index = SubmissionIndex(csv_file, patch_size)
+    other_index = SubmissionIndex(other_csv_file, patch_size)
+    if id_img not in index or id_img not in other_index:
+        print("Sorry the provided id of the image has not been found in both csv")
+        sys.exit(1)
+
+    diff = index.diff(other_index, id_img)
+    img = load_image(id_img, path_to_images)
+
+    print("[INFO] Road patches added: {}, removed: {}".format((diff == 1).sum(), (diff == -1).sum()))
+    for value, channels in ((1, [0, 2]), (-1, [1, 2])):
+        for x, y in zip(*np.nonzero(diff == value)):
+            for channel in channels:
+                img[x * patch_size:(x + 1) * patch_size, y * patch_size:(y + 1) * patch_size, channel] = 0
+    plt.imshow(img)
+    plt.show()
+
+
+def visualize_probabilities(id_img, store_directory, path_to_images, patch_size, threshold=0.5):
+    """Shows an image from a prediction store, its red channel dimmed by the road probability of each patch."""
+    store = PredictionStore(store_directory)
+    if id_img not in store:
+        print("Sorry the provided id of the image has not been found in the stored predictions")
+        sys.exit(1)
+
+    grid = store.grid(id_img).astype(np.float32)
+    img = load_image(id_img, path_to_images)
+    probabilities = np.kron(grid, np.ones((patch_size, patch_size)))[:img.shape[0], :img.shape[1]]
+
+    print("[INFO] Total predicted road patches: ", (grid > threshold).sum())
+    img[..., 0] *= 1 - probabilities
+    plt.imshow(img)
+    plt.show()